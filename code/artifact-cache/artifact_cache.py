@@ -0,0 +1,312 @@
+"""
+Local on-disk cache of the models downloaded from the MLflow model registry,
+shared by the model garden (registry.py) and the registry helpers of mlflow-intro.
+
+    root/
+        versions/<registered name>/<version>-<source key>/blob.json   version -> digest of its artifacts
+        versions/<registered name>/<version>-<source key>/MLmodel     MLmodel file alone, for the metadata
+        blobs/<digest>/                                               artifacts of a model, by content
+        leases/<digest>/<pid>                                         blob in use by the process pid
+        locks/                                                        one lock file per download
+
+A model version is immutable, so once its artifacts are downloaded they are read
+from the disk until they are evicted. The artifacts are stored under the sha256
+digest of their content, versions registered from the same run share the same
+copy. Downloads of the same version are done once, by a single thread of a single
+process, the others wait for it. The blobs are evicted least recently used first
+when the cache grows above max_bytes (ARTIFACT_CACHE_SIZE_MB, 0 for no limit), but
+never while a process holds a lease on them, nor within grace_seconds of being
+returned by model_dir.
+
+The cache folder is shared by the backend and the mlflow-intro scripts, both install
+this module as the artifact-cache package (path dependency on this folder).
+
+Run it to download a model and print its local path, e.g. for mlflow models serve,
+with the pid of the process that serves it so the blob isn't evicted meanwhile:
+
+    python -m artifact_cache models:/iris-classification-model@production [lease pid]
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import typing
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on Windows, downloads are only deduplicated within a process
+    fcntl = None
+
+DEFAULT_CACHE_DIR = os.environ.get("ARTIFACT_CACHE_DIR",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "mlflow-artifacts"))
+# 0 means no limit
+DEFAULT_MAX_BYTES = int(os.environ.get("ARTIFACT_CACHE_SIZE_MB", 4096)) * 1024 * 1024 or None
+# blobs returned by model_dir are not evicted for that long, so the caller has the time to read them
+DEFAULT_GRACE_SECONDS = 300.0
+
+
+def directory_digest(path: Path) -> str:
+    """
+    sha256 of the relative paths and contents of the files of a folder
+    """
+    digest = hashlib.sha256()
+    for file in sorted(p for p in path.rglob("*") if p.is_file()):
+        digest.update(file.relative_to(path).as_posix().encode() + b"\0")
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def directory_size(path: Path) -> int:
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+def pid_alive(pid: int) -> bool:
+    if os.name == "nt":
+        # os.kill would terminate the process, assume it's alive
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ArtifactCache:
+    """
+    Content-addressed cache of the artifacts of MLflow model versions, see the module docstring
+    """
+    def __init__(self,
+                 root: typing.Union[str, Path] = DEFAULT_CACHE_DIR,
+                 max_bytes: typing.Optional[int] = DEFAULT_MAX_BYTES,
+                 client=None,
+                 grace_seconds: float = DEFAULT_GRACE_SECONDS):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.grace_seconds = grace_seconds
+        self._client = client
+        # the file locks serialize the processes, these serialize the threads of this process
+        self.thread_locks: typing.Dict[str, threading.Lock] = dict()
+        self.thread_locks_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        for folder in ("versions", "blobs", "leases", "locks", "tmp"):
+            (self.root / folder).mkdir(parents=True, exist_ok=True)
+
+    @property
+    def client(self):
+        if self._client is None:
+            from mlflow.tracking import MlflowClient
+            self._client = MlflowClient()
+        return self._client
+
+    def model_version(self, model_uri: str):
+        """
+        Model version of a "models:/name/version" or "models:/name@alias" uri
+        """
+        if not model_uri.startswith("models:/"):
+            raise ValueError(f"Expected a models:/name/version or models:/name@alias uri, got '{model_uri}'")
+        target = model_uri[len("models:/"):].strip("/")
+        if "@" in target:
+            return self.client.get_model_version_by_alias(*target.rsplit("@", 1))
+        name, _, version = target.rpartition("/")
+        if not name or not version.isdigit():
+            raise ValueError(f"Expected a models:/name/version or models:/name@alias uri, got '{model_uri}'")
+        return self.client.get_model_version(name, version)
+
+    def model_dir(self, model_version, lease_pid: typing.Optional[int] = None) -> Path:
+        """
+        Local folder with all the artifacts of a model version, downloaded on the first call.
+        With lease_pid, the blob is leased to that process until release or until it exits.
+        """
+        ref_dir = self.__ref_dir(model_version)
+        with self.__lock(ref_dir):
+            # under the lock of the blobs, an eviction can't delete it between the check and the lease
+            with self.__lock(self.root / "blobs"):
+                blob = self.__blob(ref_dir)
+                if blob is not None:
+                    self.hits += 1
+                    self.__use(blob, lease_pid)
+                    return blob
+            self.misses += 1
+            blob = self.__download(model_version, ref_dir, lease_pid)
+        self.evict()
+        return blob
+
+    def release(self, blob: Path, pid: typing.Optional[int] = None):
+        """
+        Release the lease of a process (this one by default) on a blob returned by model_dir
+        """
+        lease = self.root / "leases" / blob.name / str(os.getpid() if pid is None else pid)
+        lease.unlink(missing_ok=True)
+
+    def model_metadata(self, model_version):
+        """
+        MLmodel of a model version (flavors, signature, ...), read from the cached artifacts
+        when the model was already downloaded, otherwise only the MLmodel file is fetched
+        """
+        from mlflow.models import Model
+        ref_dir = self.__ref_dir(model_version)
+        blob = self.__blob(ref_dir)
+        if blob is not None:
+            return Model.load(str(blob))
+        mlmodel_path = ref_dir / "MLmodel"
+        with self.__lock(ref_dir):
+            if not mlmodel_path.exists():
+                import mlflow
+                tmp_dir = self.__tmp_dir()
+                try:
+                    local_path = mlflow.artifacts.download_artifacts(
+                        artifact_uri=f"{self.__download_uri(model_version)}/MLmodel", dst_path=str(tmp_dir))
+                    os.replace(local_path, mlmodel_path)
+                finally:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+        return Model.load(str(ref_dir))
+
+    def evict(self):
+        """
+        Delete the least recently used blobs until the cache fits in max_bytes,
+        except the leased blobs and the ones used within grace_seconds
+        """
+        if self.max_bytes is None:
+            return
+        with self.__lock(self.root / "blobs"):
+            blobs = sorted(self.blobs(), key=lambda blob: blob.stat().st_mtime)
+            sizes = {blob.name: directory_size(blob) for blob in blobs}
+            total = sum(sizes.values())
+            recent = time.time() - self.grace_seconds
+            for blob in blobs:
+                if total <= self.max_bytes:
+                    break
+                if blob.stat().st_mtime > recent or self.__leased(blob):
+                    continue
+                # rename first, a reader never sees a partially deleted blob
+                trash = self.__tmp_dir()
+                os.replace(blob, trash / blob.name)
+                shutil.rmtree(trash, ignore_errors=True)
+                shutil.rmtree(self.root / "leases" / blob.name, ignore_errors=True)
+                total -= sizes[blob.name]
+                self.evictions += 1
+
+    def blobs(self) -> typing.List[Path]:
+        return [blob for blob in (self.root / "blobs").iterdir() if blob.is_dir()]
+
+    def stats(self) -> dict:
+        return {
+            "root": str(self.root),
+            "max_bytes": self.max_bytes,
+            "size_bytes": sum(directory_size(blob) for blob in self.blobs()),
+            "blobs": len(self.blobs()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __download_uri(self, model_version) -> str:
+        return self.client.get_model_version_download_uri(model_version.name, model_version.version)
+
+    def __ref_dir(self, model_version) -> Path:
+        # a deleted version can be registered again under the same number from another run
+        source_key = hashlib.blake2b(f"{model_version.source}|{model_version.run_id}".encode(),
+                                     digest_size=8).hexdigest()
+        ref_dir = self.root / "versions" / model_version.name / f"{model_version.version}-{source_key}"
+        ref_dir.mkdir(parents=True, exist_ok=True)
+        return ref_dir
+
+    def __blob(self, ref_dir: Path) -> typing.Optional[Path]:
+        """
+        Blob of a version, None when it was never downloaded or its blob was evicted since
+        """
+        ref_path = ref_dir / "blob.json"
+        if not ref_path.exists():
+            return None
+        blob = self.root / "blobs" / json.loads(ref_path.read_text())["digest"]
+        return blob if (blob / "MLmodel").exists() else None
+
+    def __use(self, blob: Path, lease_pid: typing.Optional[int]):
+        """
+        Mark a blob as just used, and leased to lease_pid. Called under the lock of the blobs
+        """
+        os.utime(blob)
+        if lease_pid is not None:
+            lease_dir = self.root / "leases" / blob.name
+            lease_dir.mkdir(exist_ok=True)
+            (lease_dir / str(lease_pid)).touch()
+
+    def __leased(self, blob: Path) -> bool:
+        leased = False
+        lease_dir = self.root / "leases" / blob.name
+        if lease_dir.is_dir():
+            for lease in lease_dir.iterdir():
+                if lease.name.isdigit() and pid_alive(int(lease.name)):
+                    leased = True
+                else:
+                    # the process exited without releasing it
+                    lease.unlink(missing_ok=True)
+        return leased
+
+    def __download(self, model_version, ref_dir: Path, lease_pid: typing.Optional[int] = None) -> Path:
+        import mlflow
+        tmp_dir = self.__tmp_dir()
+        try:
+            download_uri = self.__download_uri(model_version)
+            local_path = Path(mlflow.artifacts.download_artifacts(artifact_uri=download_uri, dst_path=str(tmp_dir)))
+            digest = directory_digest(local_path)
+            blob = self.root / "blobs" / digest
+            # another version with the same artifacts may be downloaded at the same time
+            with self.__lock(self.root / "blobs"):
+                if not blob.exists():
+                    try:
+                        os.replace(local_path, blob)
+                    except OSError:
+                        # moved there by a process that doesn't share the locks (no fcntl)
+                        if not (blob / "MLmodel").exists():
+                            raise
+                # same artifacts as another version, keep the copy already there
+                self.__use(blob, lease_pid)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_ref = ref_dir / f"blob.json.tmp-{os.getpid()}"
+        tmp_ref.write_text(json.dumps({"digest": digest, "source": download_uri, "run_id": model_version.run_id}))
+        os.replace(tmp_ref, ref_dir / "blob.json")
+        return blob
+
+    def __tmp_dir(self) -> Path:
+        # on the same file system as the blobs so os.replace is atomic
+        tmp_dir = self.root / "tmp" / uuid.uuid4().hex
+        tmp_dir.mkdir(parents=True)
+        return tmp_dir
+
+    @contextmanager
+    def __lock(self, path: Path):
+        key = hashlib.blake2b(str(path.relative_to(self.root)).encode(), digest_size=8).hexdigest()
+        with self.thread_locks_lock:
+            thread_lock = self.thread_locks.setdefault(key, threading.Lock())
+        with thread_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.root / "locks" / f"{key}.lock", "w") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        sys.exit("usage: python -m artifact_cache models:/name/version|models:/name@alias [lease pid]")
+    cache = ArtifactCache()
+    print(cache.model_dir(cache.model_version(sys.argv[1]), lease_pid=int(sys.argv[2]) if len(sys.argv) == 3 else None))
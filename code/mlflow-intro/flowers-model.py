@@ -1,3 +1,7 @@
+import os
+import re
+import time
+from functools import partial
 import mlflow
 import tensorflow as tf
 import numpy as np
@@ -13,8 +17,15 @@ from sklearn.metrics import ConfusionMatrixDisplay
 import matplotlib.pyplot as plt
 from tensorflow.keras.layers import Conv2D, Input, Dense, Flatten
 from tensorflow.keras.models import Model
+from run_logger import RunLogger
+from trial_scheduler import TrialScheduler, MedianStoppingRule, summarize_trials
 
 IMG_SIZE = 180
+# folder of the tf.data cache of the resized images, one cache per split and image size.
+# Set it to an empty string to cache the images in memory instead
+DATA_CACHE_DIR = os.environ.get("FLOWERS_DATA_CACHE_DIR", "data-cache")
+# tfds spec of each split, part of the key of its cache
+SPLITS = {"train": "train[:80%]", "validation": "train[80%:90%]", "test": "train[90%:]"}
 
 
 def fetch_data():
@@ -25,30 +36,39 @@ def fetch_data():
     # Fetch data from the web
     (ds_train, ds_validation, ds_test), metadata = tfds.load(
         "tf_flowers",
-        split=['train[:80%]', 'train[80%:90%]', 'train[90%:]'],
+        split=[SPLITS["train"], SPLITS["validation"], SPLITS["test"]],
         as_supervised=True,
         with_info=True
     )
     return ds_train, ds_validation, ds_test, metadata
 
 
-def preprocess_data(ds_subset, batch_size=32, shuffle=False, augment=False):
+def data_cache_path(split):
     """
-    Preprocess the data
-    :param ds_train:
-    :param ds_validation:
-    :param ds_test:
-    :param metadata:
+    File of the tf.data cache of a split, keyed by the spec of the split and the image size
+    so changing SPLITS or IMG_SIZE never reads stale images
+    :param split:
     :return:
     """
+    if not DATA_CACHE_DIR:
+        return ""  # in memory
+    os.makedirs(DATA_CACHE_DIR, exist_ok=True)
+    spec = re.sub(r"[^0-9A-Za-z]+", "_", SPLITS[split]).strip("_")
+    return os.path.join(DATA_CACHE_DIR, f"tf_flowers-{split}-{spec}-{IMG_SIZE}px")
+
+
+def preprocess_data(ds_subset, batch_size=32, shuffle=False, augment=False, split=None):
+    """
+    Prepare the data for training. The decoded and resized images are cached after
+    the first epoch, so the following epochs and trials don't decode the JPEGs again.
+    The random augmentation runs after the cache to stay different on every epoch.
+    :param ds_subset:
+    :param batch_size:
+    :param shuffle:
+    :param augment:
+    :param split: name of the split in SPLITS, used as the key of its cache. No cache when it is None
+    :return:
     """
-            Prepare the data for training
-            :param ds_subset: 
-            :param batch_size: 
-            :param shuffle: 
-            :param augment: 
-            :return: 
-            """
     resize_and_rescale = Sequential([
         keras.layers.experimental.preprocessing.Resizing(IMG_SIZE, IMG_SIZE),
         keras.layers.experimental.preprocessing.Rescaling(1. / 255)
@@ -63,6 +83,10 @@ def preprocess_data(ds_subset, batch_size=32, shuffle=False, augment=False):
     ds_subset = ds_subset.map(lambda x, y: (resize_and_rescale(x), y),
                               num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
+    # cache the deterministic part of the pipeline
+    if split is not None:
+        ds_subset = ds_subset.cache(data_cache_path(split))
+
     # shuffle the dataset if needed
     if shuffle:
         ds_subset = ds_subset.shuffle(1000)
@@ -105,13 +129,90 @@ def build_model(num_classes, filters):
     return model
 
 
-def train_model(model, ds_train, ds_validation, epochs=15):
+def measure_input_throughput(ds_subset, epochs=2):
+    """
+    Iterate over the input pipeline alone and return the images per second of each epoch.
+    The first epoch decodes the images and fills the cache, the next ones read the cache
+    :param ds_subset:
+    :param epochs:
+    :return:
+    """
+    throughput = []
+    for _ in range(epochs):
+        start = time.perf_counter()
+        num_images = 0
+        for images, _ in ds_subset:
+            num_images += int(images.shape[0])
+        throughput.append(num_images / (time.perf_counter() - start))
+    return throughput
+
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    """
+    Log the training throughput of each epoch in images per second. When it is close
+    to the throughput of the input pipeline alone, training is bound by the input.
+    Only the training batches are timed, not the validation at the end of the epoch
+    """
+
+    def __init__(self, logger, batch_size, input_throughput=None):
+        super().__init__()
+        self.logger = logger
+        self.batch_size = batch_size
+        self.input_throughput = input_throughput
+        self.train_start = None
+        self.train_end = 0.0
+        self.num_batches = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.train_start = None
+        self.num_batches = 0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.train_start is None:
+            self.train_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.num_batches += 1
+        self.train_end = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.train_start is None:
+            return
+        # the last batch may be smaller, close enough for a throughput report
+        images_per_sec = self.num_batches * self.batch_size / (self.train_end - self.train_start)
+        self.logger.log_metric("train_images_per_sec", images_per_sec, step=epoch)
+        report = f"epoch {epoch}: training {images_per_sec:.1f} images/s"
+        if self.input_throughput:
+            ratio = images_per_sec / self.input_throughput
+            bound = "input" if ratio > 0.8 else "compute"
+            report += f", input pipeline {self.input_throughput:.1f} images/s ({bound} bound)"
+        print(report)
+
+
+class TrialReportCallback(tf.keras.callbacks.Callback):
+    """
+    Report the validation accuracy of each epoch to the trial scheduler, and stop
+    the training when the scheduler finds the trial clearly worse than the others
+    """
+
+    def __init__(self, reporter, metric="val_accuracy"):
+        super().__init__()
+        self.reporter = reporter
+        self.metric = metric
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs and self.metric in logs and self.reporter.report(epoch, logs[self.metric]):
+            self.model.stop_training = True
+
+
+def train_model(model, ds_train, ds_validation, epochs=15, callbacks=None):
     """
     Train the model
     :param model:
     :param ds_train:
     :param ds_validation:
     :param epochs:
+    :param callbacks:
     :return:
     """
     model.compile(
@@ -123,7 +224,8 @@ def train_model(model, ds_train, ds_validation, epochs=15):
     history = model.fit(
         ds_train,
         validation_data=ds_validation,
-        epochs=epochs
+        epochs=epochs,
+        callbacks=callbacks
     )
     return history
 
@@ -140,7 +242,7 @@ def get_metrics_figure(history):
     loss = history.history['loss']
     val_loss = history.history['val_loss']
 
-    epochs_range = range(10)
+    epochs_range = range(len(acc))
 
     fig = plt.figure(figsize=(8, 8))
     plt.subplot(1, 2, 1)
@@ -179,12 +281,51 @@ def get_confusion_matrix_figure(model, transformed_ds_test, metadata):
     return fig
 
 
-def run_experiment(experiment_name: str):
+def train_trial(params, reporter, input_throughput=None):
     """
-    Run the experiment
-    :return:
+    Train and evaluate the model with one filters configuration, run by the trial
+    scheduler in its own nested MLflow run
+    :param params: {"filters": [...], "epochs": ...}
+    :param reporter:
+    :param input_throughput: images per second of the input pipeline alone
+    :return: final metrics of the trial
     """
     mlflow.autolog()
+    # the splits are read from the cache filled by the parent process
+    ds_train, ds_validation, ds_test, metadata = fetch_data()
+    transformed_ds_train = preprocess_data(ds_train, batch_size=32, shuffle=True, augment=True, split="train")
+    transformed_ds_validation = preprocess_data(ds_validation, batch_size=32, split="validation")
+    transformed_ds_test = preprocess_data(ds_test, batch_size=32, split="test")
+
+    # Build the model
+    num_classes = metadata.features['label'].num_classes
+    model = build_model(num_classes, params["filters"])
+    with RunLogger() as logger:
+        # Train the model
+        history = train_model(model, transformed_ds_train, transformed_ds_validation, epochs=params["epochs"],
+                              callbacks=[ThroughputCallback(logger, 32, input_throughput),
+                                         TrialReportCallback(reporter)])
+
+        # generating training artifacts
+        # Get the metrics figures
+        metrics_fig = get_metrics_figure(history)
+
+        # Get the confusion matrix figure
+        confusion_matrix_fig = get_confusion_matrix_figure(model, transformed_ds_test, metadata)
+
+        logger.log_figure(metrics_fig, "metrics.png")
+        logger.log_figure(confusion_matrix_fig, "confusion_matrix.png")
+    return {"val_accuracy": history.history["val_accuracy"][-1], "epochs": len(history.history["val_accuracy"])}
+
+
+def run_experiment(experiment_name: str, max_parallel=None, cpus_per_trial=None):
+    """
+    Run the experiment, the filters configurations are trained concurrently
+    :param experiment_name:
+    :param max_parallel: trials run at the same time, all of them by default
+    :param cpus_per_trial: cores of each trial, the cores are split between the trials by default
+    :return:
+    """
     experiment = mlflow.get_experiment_by_name(experiment_name)
     if experiment:
         print("Experiment already exists.")
@@ -193,34 +334,34 @@ def run_experiment(experiment_name: str):
         print("Creating a new experiment")
         experiment_id = mlflow.create_experiment(experiment_name)
 
+    trials_filters = [[32, 64], [32, 64, 128], [32, 64, 128, 256]]
+    trials = {f"filters-{'-'.join(map(str, filters))}": {"filters": filters, "epochs": 10}
+              for filters in trials_filters}
+
     with mlflow.start_run(experiment_id=experiment_id, run_name="flowers-classification") as run:
 
         # Fetch the data
         ds_train, ds_validation, ds_test, metadata = fetch_data()
 
         # Preprocess the data
-        transformed_ds_train = preprocess_data(ds_train, batch_size=32, shuffle=True, augment=True)
-        transformed_ds_validation = preprocess_data(ds_validation, batch_size=32)
-        transformed_ds_test = preprocess_data(ds_test, batch_size=32)
-
-        # Build the model
-        num_classes = metadata.features['label'].num_classes
-        trials_filters = [[32, 64], [32, 64, 128], [32, 64, 128, 256]]
-        for filters in trials_filters:
-            with mlflow.start_run(nested=True):
-                model = build_model(num_classes, filters)
-                # Train the model
-                history = train_model(model, transformed_ds_train, transformed_ds_validation, epochs=10)
-
-                # generating training artifacts
-                # Get the metrics figures
-                metrics_fig = get_metrics_figure(history)
-
-                # Get the confusion matrix figure
-                confusion_matrix_fig = get_confusion_matrix_figure(model, transformed_ds_test, metadata)
-
-                mlflow.log_figure(metrics_fig, "metrics.png")
-                mlflow.log_figure(confusion_matrix_fig, "confusion_matrix.png")
+        transformed_ds_train = preprocess_data(ds_train, batch_size=32, shuffle=True, augment=True, split="train")
+        transformed_ds_validation = preprocess_data(ds_validation, batch_size=32, split="validation")
+        transformed_ds_test = preprocess_data(ds_test, batch_size=32, split="test")
+
+        # the first epoch fills the cache of the training split, the second one reads it
+        input_throughput = measure_input_throughput(transformed_ds_train, epochs=2)
+        with RunLogger() as logger:
+            for epoch, images_per_sec in enumerate(input_throughput):
+                logger.log_metric("input_images_per_sec", images_per_sec, step=epoch)
+                print(f"input pipeline epoch {epoch}: {images_per_sec:.1f} images/s")
+        # fill the other caches before the trials read them concurrently
+        measure_input_throughput(transformed_ds_validation, epochs=1)
+        measure_input_throughput(transformed_ds_test, epochs=1)
+
+        scheduler = TrialScheduler(max_parallel=max_parallel or len(trials), cpus_per_trial=cpus_per_trial,
+                                   stopping_rule=MedianStoppingRule(mode="max", grace_steps=3, margin=0.05))
+        results = scheduler.run(partial(train_trial, input_throughput=input_throughput[-1]), trials)
+        summarize_trials(results, "val_accuracy")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,65 @@
+import base64
+from io import BytesIO
+
+import mlflow
+import numpy as np
+import pandas
+from PIL import Image
+
+IMG_SIZE = 180
+NPY_MAGIC = b"\x93NUMPY"
+
+
+def decode_image(image_b64: str) -> np.ndarray:
+    """
+    Decode a base64 .npy array or JPEG image into a normalized float32 array
+    :param image_b64:
+    :return:
+    """
+    image_bytes = base64.b64decode(image_b64)
+    if image_bytes.startswith(NPY_MAGIC):
+        image_arr = np.load(BytesIO(image_bytes), allow_pickle=False)
+    else:
+        image = Image.open(BytesIO(image_bytes))
+        image.draft("RGB", (IMG_SIZE, IMG_SIZE))
+        image = image.convert("RGB").resize((IMG_SIZE, IMG_SIZE))
+        image_arr = np.asarray(image)
+    if image_arr.dtype == np.uint8:
+        return image_arr.astype(np.float32) * np.float32(1.0 / 255.0)
+    return image_arr.astype(np.float32)
+
+
+class FlowersImageModel(mlflow.pyfunc.PythonModel):
+    """
+    Wrap the flowers keras model so it can be called with binary images,
+    one base64 .npy or JPEG per row of the "image" column
+    """
+
+    def load_context(self, context):
+        self.model = mlflow.tensorflow.load_model(context.artifacts["keras_model"])
+
+    def predict(self, context, model_input: pandas.DataFrame, params=None):
+        images = np.stack([decode_image(image_b64) for image_b64 in model_input["image"]])
+        return self.model(images, training=False).numpy()
+
+
+def log_flowers_image_model(keras_model_uri: str, registered_model_name: str):
+    """
+    Log and register the image model on top of an already logged keras model
+    :param keras_model_uri: e.g. models:/flowers-classification-model@production
+    :param registered_model_name:
+    :return:
+    """
+    with mlflow.start_run(run_name="flowers-image-model"):
+        return mlflow.pyfunc.log_model(
+            "model",
+            python_model=FlowersImageModel(),
+            artifacts={"keras_model": keras_model_uri},
+            registered_model_name=registered_model_name
+        )
+
+
+if __name__ == '__main__':
+    mlflow.set_tracking_uri("http://0.0.0.0:4001")
+    log_flowers_image_model("models:/flowers-classification-model@production",
+                            "flowers-classification-image-model")
@@ -1,7 +1,10 @@
 # third party libraries
+import argparse
+import time
 import typing
 import warnings
 from datetime import datetime
+import numpy as np
 import pandas
 import seaborn as sns
 from sklearn.datasets import load_iris
@@ -9,21 +12,31 @@ from sklearn.datasets import load_iris
 import matplotlib.pyplot as plt
 # MLflow libraries
 import mlflow
+from mlflow.entities import Metric, Param
 from mlflow.models.signature import infer_signature
+from mlflow.tracking import MlflowClient
 
 # ML libraries  for the analysis
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import accuracy_score
 from sklearn.metrics import confusion_matrix
-from sklearn.model_selection import train_test_split
+from sklearn.base import clone
+from sklearn.model_selection import StratifiedKFold, train_test_split
+from joblib import Memory, Parallel, delayed
 from sklearn.naive_bayes import GaussianNB
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.svm import SVC
 from sklearn.tree import DecisionTreeClassifier
 
+from run_logger import RunLogger
+from trial_scheduler import TrialScheduler, summarize_trials
+
 warnings.filterwarnings("ignore")
 
+# cache of the cross-validation folds, keyed by the labels, number of folds and seed
+FOLDS_CACHE = Memory(location=".cache/folds", verbose=0)
+
 
 # Function to load the dataset
 def fetch_data() -> pandas.DataFrame:
@@ -55,18 +68,12 @@ def split_dataset(data: pandas.DataFrame, test_size=0.2, random_state=7) -> typi
     return X_train, X_validation, Y_train, Y_validation
 
 
-def run_experiment(experiment_name):
+def build_models() -> typing.Dict[str, typing.Any]:
     """
-    Run the experiment
-    :param experiment_name:
+    Make a dictionary with the algorithms to be evaluated
     :return:
     """
-    # 1. Load the data
-    data = fetch_data()
-    # 2. Split the dataset
-    X_train, X_validation, Y_train, Y_validation = split_dataset(data)
-    # 3. make a dictionary with the algorithms to be evaluated
-    models = {
+    return {
         'LR': LogisticRegression(solver='liblinear', multi_class='ovr'),
         'LDA': LinearDiscriminantAnalysis(),
         'KNN': KNeighborsClassifier(),
@@ -75,6 +82,53 @@ def run_experiment(experiment_name):
         'SVM': SVC(gamma='auto')
     }
 
+
+def train_trial(params: dict, reporter) -> dict:
+    """
+    Train and evaluate one algorithm, run by the trial scheduler in its own nested MLflow run
+    :param params: {"model_name": ...}
+    :param reporter: unused, the sklearn models are fitted in a single step
+    :return: final metrics of the trial
+    """
+    model_name = params["model_name"]
+    model = build_models()[model_name]
+    X_train, X_validation, Y_train, Y_validation = split_dataset(fetch_data())
+
+    with RunLogger() as logger:
+        # train the model
+        model.fit(X_train, Y_train)
+        logger.log_param("model_name", model_name)
+
+        # make predictions
+        predictions = model.predict(X_validation)
+        accuracy = accuracy_score(Y_validation, predictions)
+        logger.log_metric("accuracy", accuracy)
+
+        # log the confusion matrix
+        cm = confusion_matrix(Y_validation, predictions)
+        fig = plt.figure()
+        ax = fig.add_subplot(111)
+        ax.set_title(f"Confusion Matrix for {model_name}")
+        sns.heatmap(cm, annot=True, ax=ax, fmt='g')
+        plt.xlabel('Predicted')
+        plt.ylabel('True')
+        logger.log_figure(fig, f"confusion_matrix_{model_name}.png")
+
+        # log the model
+        signature = infer_signature(X_train.head(5), model.predict(X_train.head(5)))
+        logger.log_sklearn_model(model, "model", signature=signature)
+    print(f"{model_name} accuracy: {accuracy}, run_id: {mlflow.active_run().info.run_id}")
+    return {"accuracy": accuracy}
+
+
+def run_experiment(experiment_name, max_parallel=None, cpus_per_trial=1):
+    """
+    Run the experiment, each algorithm is trained concurrently in its own nested run
+    :param experiment_name:
+    :param max_parallel: trials run at the same time, as many as the cores allow by default
+    :param cpus_per_trial:
+    :return:
+    """
     # create mlfow experiment if it does not exist
     # otherwise, get the experiment id
     experiment = mlflow.get_experiment_by_name(experiment_name)
@@ -87,42 +141,113 @@ def run_experiment(experiment_name):
         print("Creating a new experiment")
         experiment_id = mlflow.create_experiment(experiment_name)
 
-    # Run each model in a separate run
-    for model_name, model in models.items():
-        print(f"Running {model_name}...")
-
-        # create unique id for the run
-        run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
-        run_id = f"{model_name}-{run_id}"
-
-        # start the run and log the parameters
-        with mlflow.start_run(experiment_id=experiment_id, run_name=run_id) as run:
-            # train the model
-            model.fit(X_train, Y_train)
-            mlflow.log_param("model_name", model_name)
-
-            # make predictions
-            predictions = model.predict(X_validation)
-            accuracy = accuracy_score(Y_validation, predictions)
-            mlflow.log_metric("accuracy", accuracy)
-
-            # log the confusion matrix
-            cm = confusion_matrix(Y_validation, predictions)
-            fig = plt.figure()
-            ax = fig.add_subplot(111)
-            ax.set_title(f"Confusion Matrix for {model_name}")
-            sns.heatmap(cm, annot=True, ax=ax, fmt='g')
-            plt.xlabel('Predicted')
-            plt.ylabel('True')
-            mlflow.log_figure(fig, f"confusion_matrix_{model_name}.png")
-
-            # log the model
-            signature = infer_signature(X_train, model.predict(X_train))
-            mlflow.sklearn.log_model(model, "model", signature=signature)
-            print(f"{model_name} accuracy: {accuracy}, run_id: {run.info.run_id}")
+    # create unique id for the run
+    run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+    trials = {f"{model_name}-{run_id}": {"model_name": model_name} for model_name in build_models()}
+
+    with mlflow.start_run(experiment_id=experiment_id, run_name=f"iris-trials-{run_id}"):
+        scheduler = TrialScheduler(max_parallel=max_parallel, cpus_per_trial=cpus_per_trial)
+        results = scheduler.run(train_trial, trials)
+        best = summarize_trials(results, "accuracy")
+        if best is not None:
+            print(f"Best model: {best['params']['model_name']} accuracy: {best['metrics']['accuracy']}")
+
+
+@FOLDS_CACHE.cache
+def get_folds(y: np.ndarray, n_splits: int = 5, random_state: int = 7) -> typing.List[typing.Tuple[np.ndarray, np.ndarray]]:
+    """
+    Stratified k-fold (train, test) indices, computed once and cached on disk
+    :param y:
+    :param n_splits:
+    :param random_state:
+    :return:
+    """
+    splitter = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    return list(splitter.split(np.zeros(len(y)), y))
+
+
+def fit_and_score(model_name: str, model, X: np.ndarray, y: np.ndarray, fold: int,
+                  train_index: np.ndarray, test_index: np.ndarray) -> dict:
+    """
+    Fit a copy of the model on one fold and return its accuracy and timings
+    :return:
+    """
+    model = clone(model)
+    start = time.perf_counter()
+    model.fit(X[train_index], y[train_index])
+    fit_time = time.perf_counter() - start
+    start = time.perf_counter()
+    accuracy = accuracy_score(y[test_index], model.predict(X[test_index]))
+    score_time = time.perf_counter() - start
+    return {"model_name": model_name, "fold": fold, "accuracy": accuracy,
+            "fit_time": fit_time, "score_time": score_time}
+
+
+def run_cv_experiment(experiment_name, n_splits=5, n_jobs=-1):
+    """
+    Compare the algorithms with k-fold cross-validation. Every (model, fold) pair is an
+    independent job, so all of them are spread over the cores at once instead of the
+    runtime growing with models x folds. The results of each model are logged to its
+    nested run with a single batched call.
+    :param experiment_name:
+    :param n_splits:
+    :param n_jobs: parallel jobs, -1 uses all the cores
+    :return:
+    """
+    data = fetch_data()
+    X = data.iloc[:, 0:4].to_numpy()
+    y = data.iloc[:, 4].to_numpy()
+    folds = get_folds(y, n_splits=n_splits)
+    models = build_models()
+
+    experiment = mlflow.get_experiment_by_name(experiment_name)
+    experiment_id = experiment.experiment_id if experiment else mlflow.create_experiment(experiment_name)
+
+    # large arrays are memory-mapped by joblib and shared with the workers instead of copied per job
+    start = time.perf_counter()
+    scores = Parallel(n_jobs=n_jobs)(
+        delayed(fit_and_score)(model_name, model, X, y, fold, train_index, test_index)
+        for model_name, model in models.items()
+        for fold, (train_index, test_index) in enumerate(folds)
+    )
+    print(f"{len(scores)} fits in {time.perf_counter() - start:.2f}s")
+
+    client = MlflowClient()
+    run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+    with mlflow.start_run(experiment_id=experiment_id, run_name=f"iris-cv-{run_id}") as parent_run:
+        summary = []
+        for model_name in models:
+            model_scores = [score for score in scores if score["model_name"] == model_name]
+            accuracies = np.array([score["accuracy"] for score in model_scores])
+            timestamp = int(time.time() * 1000)
+            metrics = [Metric("cv_mean_accuracy", float(accuracies.mean()), timestamp, 0),
+                       Metric("cv_std_accuracy", float(accuracies.std()), timestamp, 0)]
+            for score in model_scores:
+                for key in ("accuracy", "fit_time", "score_time"):
+                    metrics.append(Metric(f"fold_{key}", float(score[key]), timestamp, score["fold"]))
+            params = [Param("model_name", model_name), Param("n_splits", str(n_splits))]
+
+            run = client.create_run(experiment_id, run_name=f"{model_name}-cv-{run_id}",
+                                    tags={"mlflow.parentRunId": parent_run.info.run_id})
+            client.log_batch(run.info.run_id, metrics=metrics, params=params)
+            client.set_terminated(run.info.run_id)
+            summary.append((model_name, accuracies.mean(), accuracies.std()))
+
+        for model_name, mean, std in sorted(summary, key=lambda row: -row[1]):
+            print(f"{model_name:<5} accuracy: {mean:.4f} (+/- {std:.4f})")
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the iris classifiers")
+    parser.add_argument("--mode", choices=["holdout", "cv"], default="holdout",
+                        help="holdout: one train/validation split, cv: k-fold cross-validation")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--n-jobs", type=int, default=-1)
+    args = parser.parse_args()
+
     mlflow.set_tracking_uri("http://0.0.0.0:4001")
     experiment_name = "iris-classification"
-    run_experiment(experiment_name)
+    if args.mode == "cv":
+        run_cv_experiment(experiment_name, n_splits=args.folds, n_jobs=args.n_jobs)
+    else:
+        run_experiment(experiment_name)
@@ -1,22 +1,94 @@
+import argparse
+import functools
+import os
+import tempfile
+import time
 import mlflow
+from mlflow.entities import ViewType
 from mlflow.tracking import MlflowClient
 
+# same cache as the model garden backend (code/artifact-cache), the downloads of one are reused by the other
+from artifact_cache import ArtifactCache
 
-def get_best_run_id(experiment_name: str) -> str:
+# page size of the paginated registry searches
+PAGE_SIZE = 1000
+
+
+@functools.lru_cache(maxsize=None)
+def get_client() -> MlflowClient:
+    """
+    Client shared by the helpers, created once for the tracking uri of the process
+    """
+    return MlflowClient()
+
+
+@functools.lru_cache(maxsize=None)
+def get_artifact_cache() -> ArtifactCache:
+    """
+    Local cache of the model artifacts, in ARTIFACT_CACHE_DIR (~/.cache/mlflow-artifacts by default)
     """
-    Get the best run
+    return ArtifactCache(client=get_client())
+
+
+@functools.lru_cache(maxsize=None)
+def get_experiment_id(experiment_name: str) -> str:
+    """
+    Id of an experiment, looked up once per process since it never changes
     :param experiment_name:
     :return:
     """
-    # Get the best run
-    client = MlflowClient()
-    experiment = client.get_experiment_by_name(experiment_name)
+    experiment = get_client().get_experiment_by_name(experiment_name)
     if experiment is None:
         raise Exception(f"Experiment '{experiment_name}' does not exist.")
-    experiment_id = experiment.experiment_id
-    runs = mlflow.search_runs(experiment_id)
-    best_run = runs.sort_values(by=['metrics.accuracy'], ascending=False).iloc[0]
-    return best_run["run_id"]
+    return experiment.experiment_id
+
+
+def get_best_run_id(experiment_name: str, metric: str = "accuracy") -> str:
+    """
+    Get the best run, the tracking server sorts the runs and returns only the first one
+    :param experiment_name:
+    :param metric:
+    :return:
+    """
+    runs = get_client().search_runs(
+        experiment_ids=[get_experiment_id(experiment_name)],
+        run_view_type=ViewType.ACTIVE_ONLY,
+        order_by=[f"metrics.`{metric}` DESC"],
+        max_results=1
+    )
+    if len(runs) == 0 or metric not in runs[0].data.metrics:
+        raise Exception(f"No run of experiment '{experiment_name}' has the metric '{metric}'.")
+    return runs[0].info.run_id
+
+
+def iter_model_versions(model_name: str):
+    """
+    Iterate over all the versions of a model, one page of results at a time
+    :param model_name:
+    :return:
+    """
+    client = get_client()
+    page_token = None
+    while True:
+        page = client.search_model_versions(f"name='{model_name}'", max_results=PAGE_SIZE,
+                                            page_token=page_token)
+        yield from page
+        page_token = page.token
+        if not page_token:
+            break
+
+
+def get_latest_model_version(model_name: str):
+    """
+    Highest version of a model, ordered and limited by the registry
+    :param model_name:
+    :return:
+    """
+    versions = get_client().search_model_versions(f"name='{model_name}'",
+                                                  order_by=["version_number DESC"], max_results=1)
+    if len(versions) == 0:
+        raise Exception(f"No versions found for model '{model_name}'")
+    return versions[0]
 
 
 def delete_all_models(experiment_name):
@@ -25,16 +97,27 @@ def delete_all_models(experiment_name):
     :param experiment_name:
     :return:
     """
-    client = MlflowClient()
-    model_versions = client.search_model_versions(f"name='{experiment_name}-model'")
-    for model in model_versions:
+    client = get_client()
+    model_name = f"{experiment_name}-model"
+    for model in list(iter_model_versions(model_name)):
         client.delete_model_version(
             name=model.name,
             version=model.version
         )
-    registered_models = client.search_registered_models(f"name='{experiment_name}-model'")
+    registered_models = client.search_registered_models(f"name='{model_name}'")
     for model in registered_models:
         client.delete_registered_model(model.name)
+    get_registered_model.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def get_registered_model(model_name):
+    """
+    Registered model metadata, cached for the process (cleared by delete_all_models)
+    :param model_name:
+    :return:
+    """
+    return get_client().get_registered_model(model_name)
 
 
 def register_model(run_id, model_name):
@@ -45,9 +128,9 @@ def register_model(run_id, model_name):
     :param run_id:
     :return:
     """
-    client = MlflowClient()
+    client = get_client()
     try:
-        model = client.get_registered_model(model_name)
+        model = get_registered_model(model_name)
     except:
         model = client.create_registered_model(model_name)
     return model
@@ -61,7 +144,7 @@ def create_model_version(run_id: str, model_name: str, model_prefix: str = "/mod
     :param model_prefix:
     :return:
     """
-    client = MlflowClient()
+    client = get_client()
     run = client.get_run(run_id)
     model_url = run.info.artifact_uri + model_prefix
     model_version = client.create_model_version(
@@ -79,12 +162,9 @@ def set_model_version_alias(model_name, alias, version=None):
     :param model_name: name of the model
     :param alias: alias name
     """
-    client = MlflowClient()
+    client = get_client()
     if version is None:
-        versions = client.search_model_versions(f"name='{model_name}'")
-        if len(versions) == 0:
-            raise Exception(f"No versions found for model '{model_name}'")
-        version = versions[0].version
+        version = get_latest_model_version(model_name).version
 
     client.set_registered_model_alias(
         name=model_name,
@@ -101,11 +181,9 @@ def get_model_signature_by_version(model_name, version=None):
     :param version:
     :return:
     """
-    # Get the best run
-    client = MlflowClient()
-    model_version = client.get_model_version(model_name, version)
-    loaded_model = mlflow.pyfunc.load_model(model_version.source)
-    print(loaded_model._model_meta._signature)
+    # only the MLmodel file is fetched, not the weights
+    model_version = get_client().get_model_version(model_name, version)
+    print(get_artifact_cache().model_metadata(model_version).signature)
 
 
 def get_model_signature_by_alias(model_name, alias):
@@ -115,11 +193,20 @@ def get_model_signature_by_alias(model_name, alias):
     :param alias:
     :return:
     """
-    # Get the best run
-    client = MlflowClient()
-    model_version = client.get_model_version_by_alias(model_name, alias)
-    loaded_model = mlflow.pyfunc.load_model(model_version.source)
-    print(loaded_model._model_meta._signature)
+    # only the MLmodel file is fetched, not the weights
+    model_version = get_client().get_model_version_by_alias(model_name, alias)
+    print(get_artifact_cache().model_metadata(model_version).signature)
+
+
+def get_model_path(model_uri: str, lease_pid: int = None) -> str:
+    """
+    Local folder of a model, downloaded once to the artifact cache
+    :param model_uri: models:/name/version or models:/name@alias
+    :param lease_pid: the folder isn't evicted from the cache while this process is alive
+    :return:
+    """
+    cache = get_artifact_cache()
+    return str(cache.model_dir(cache.model_version(model_uri), lease_pid=lease_pid))
 
 
 def register_iris_model():
@@ -150,8 +237,86 @@ def register_flowers_model():
     get_model_signature_by_alias(model_name, "production")
 
 
+def benchmark_lookups(num_runs=5000, num_versions=200, repeats=20):
+    """
+    Compare the client-side lookups with the indexed ones against a throwaway
+    SQLite tracking store filled with synthetic runs and model versions
+    :param num_runs:
+    :param num_versions:
+    :param repeats:
+    :return:
+    """
+    import numpy as np
+    from mlflow.entities import Metric, Param
+
+    tmp_dir = tempfile.mkdtemp(prefix="registry-benchmark-")
+    mlflow.set_tracking_uri(f"sqlite:///{os.path.join(tmp_dir, 'mlflow.db')}")
+    mlflow.set_registry_uri(f"sqlite:///{os.path.join(tmp_dir, 'mlflow.db')}")
+    get_client.cache_clear()
+    get_experiment_id.cache_clear()
+    client = get_client()
+
+    experiment_name = "registry-benchmark"
+    model_name = f"{experiment_name}-model"
+    experiment_id = client.create_experiment(experiment_name, artifact_location=os.path.join(tmp_dir, "artifacts"))
+    rng = np.random.default_rng(0)
+    print(f"creating {num_runs} runs and {num_versions} model versions in {tmp_dir}...")
+    run_ids = []
+    for i in range(num_runs):
+        run = client.create_run(experiment_id)
+        client.log_batch(run.info.run_id,
+                         metrics=[Metric("accuracy", float(rng.uniform()), 0, 0)],
+                         params=[Param("trial", str(i))])
+        client.set_terminated(run.info.run_id)
+        run_ids.append(run.info.run_id)
+    client.create_registered_model(model_name)
+    for i in range(num_versions):
+        client.create_model_version(model_name, source=f"runs:/{run_ids[i]}/model", run_id=run_ids[i])
+
+    def client_side_best_run():
+        experiment = MlflowClient().get_experiment_by_name(experiment_name)
+        runs = mlflow.search_runs(experiment.experiment_id)
+        return runs.sort_values(by=['metrics.accuracy'], ascending=False).iloc[0]["run_id"]
+
+    def client_side_latest_version():
+        versions = MlflowClient().search_model_versions(f"name='{model_name}'")
+        return max(versions, key=lambda v: int(v.version)).version
+
+    lookups = [
+        ("best run, client-side sort", client_side_best_run),
+        ("best run, indexed", lambda: get_best_run_id(experiment_name)),
+        ("latest version, client-side sort", client_side_latest_version),
+        ("latest version, indexed", lambda: get_latest_model_version(model_name).version),
+    ]
+    results = {}
+    for name, lookup in lookups:
+        results[name] = lookup()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            lookup()
+        print(f"{name:<35} {(time.perf_counter() - start) / repeats * 1000:10.1f} ms")
+    assert results["best run, client-side sort"] == results["best run, indexed"]
+    assert str(results["latest version, client-side sort"]) == str(results["latest version, indexed"])
+
+
 if __name__ == '__main__':
-    mlflow.set_tracking_uri("http://0.0.0.0:4001")
+    parser = argparse.ArgumentParser(description="Register the best models in the MLflow model registry")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="compare the registry lookups on a local SQLite store instead")
+    parser.add_argument("--runs", type=int, default=5000)
+    parser.add_argument("--versions", type=int, default=200)
+    parser.add_argument("--fetch", type=str, metavar="MODEL_URI",
+                        help="print the local path of a models:/ uri, downloading it to the artifact cache if needed")
+    parser.add_argument("--lease-pid", type=int,
+                        help="with --fetch, keep the model in the artifact cache while this process is alive")
+    args = parser.parse_args()
+
+    if args.fetch:
+        print(get_model_path(args.fetch, lease_pid=args.lease_pid))
+    elif args.benchmark:
+        benchmark_lookups(num_runs=args.runs, num_versions=args.versions)
+    else:
+        mlflow.set_tracking_uri("http://0.0.0.0:4001")
 
-    # register_iris_model()
-    register_flowers_model()
+        # register_iris_model()
+        register_flowers_model()
@@ -1,31 +1,177 @@
+import base64
+import json
+import time
+import typing
+from enum import Enum
+from io import BytesIO
+
 import numpy as np
 import requests
-import json
+from requests.adapters import HTTPAdapter
 from PIL import Image
 
 
+class Transport(Enum):
+    """
+    How the images are sent to the model server
+    """
+    json = "json"  # nested lists of floats, {"instances": [...]}
+    npy = "npy"    # base64 .npy uint8 array per image, decoded by the image model
+    jpeg = "jpeg"  # base64 JPEG bytes per image, decoded and resized by the image model
+
+
+def load_image(image_path: str, size: typing.Tuple[int, int] = (180, 180)) -> np.ndarray:
+    """
+    Load an image as an uint8 array of shape (height, width, 3)
+    :param image_path: path of the image
+    :param size: (width, height) of the model input
+    :return:
+    """
+    image = Image.open(image_path)
+    image.draft("RGB", size)
+    image = image.convert("RGB").resize(size)
+    return np.asarray(image, dtype=np.uint8)
+
+
+def encode_npy(image_arr: np.ndarray) -> str:
+    """
+    Serialize an array as base64 .npy bytes
+    :param image_arr:
+    :return:
+    """
+    buffer = BytesIO()
+    np.save(buffer, image_arr, allow_pickle=False)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def encode_jpeg(image_arr: np.ndarray, quality: int = 95) -> str:
+    """
+    Serialize an uint8 image as base64 JPEG bytes
+    :param image_arr:
+    :param quality:
+    :return:
+    """
+    buffer = BytesIO()
+    Image.fromarray(image_arr).save(buffer, format="JPEG", quality=quality)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class ModelClient:
+    """
+    Client of a model served with `mlflow models serve`. A single pooled
+    requests.Session is reused, so the TCP connections are kept alive between calls.
+    """
+
+    def __init__(self, url: str, timeout: float = 30.0, pool_size: int = 10):
+        """
+        :param url: base url of the model server, e.g. http://127.0.0.1:8081
+        :param timeout: timeout of each request in seconds
+        :param pool_size: max number of connections kept open with the server
+        """
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.last_payload_size = 0
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def invocations(self, payload: bytes) -> dict:
+        """
+        Call the /invocations endpoint with an already serialized JSON payload
+        :param payload:
+        :return:
+        """
+        self.last_payload_size = len(payload)
+        response = self.session.post(f"{self.url}/invocations",
+                                     data=payload,
+                                     headers={"Content-Type": "application/json"},
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def predict_records(self, records: typing.List[dict]) -> list:
+        """
+        Score a batch of tabular records, e.g. [{"sepal length (cm)": 5, ...}]
+        :param records:
+        :return:
+        """
+        return self.invocations(json.dumps({"instances": records}).encode())["predictions"]
+
+    def predict_images(self, images: typing.List[np.ndarray], transport: Transport = Transport.json) -> np.ndarray:
+        """
+        Score a batch of uint8 images in a single request
+        :param images: list of uint8 arrays of shape (height, width, 3)
+        :param transport: json sends the normalized pixels as nested lists (plain keras model),
+            npy and jpeg send base64 bytes (image model from flowers_image_model.py)
+        :return: class scores, one row per image
+        """
+        if transport == Transport.json:
+            instances = [(image_arr / 255.0).tolist() for image_arr in images]
+            payload = {"instances": instances}
+        elif transport == Transport.npy:
+            payload = {"dataframe_split": {"columns": ["image"], "data": [[encode_npy(x)] for x in images]}}
+        elif transport == Transport.jpeg:
+            payload = {"dataframe_split": {"columns": ["image"], "data": [[encode_jpeg(x)] for x in images]}}
+        else:
+            raise ValueError(f"Transport {transport} not supported")
+        predictions = self.invocations(json.dumps(payload).encode())["predictions"]
+        return np.asarray(predictions, dtype=np.float32)
+
+
+def benchmark(clients: typing.Dict[Transport, ModelClient],
+              images: typing.List[np.ndarray],
+              batch_size: int = 8,
+              repeats: int = 10) -> typing.Dict[str, dict]:
+    """
+    Compare the throughput of the transports
+    :param clients: client to use for each transport, the binary transports need the image model server
+    :param images: uint8 images to score
+    :param batch_size: images sent in each request
+    :param repeats: number of passes over the images
+    :return:
+    """
+    results = {}
+    for transport, client in clients.items():
+        n_images, n_bytes = 0, 0
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for i in range(0, len(images), batch_size):
+                batch = images[i:i + batch_size]
+                client.predict_images(batch, transport=transport)
+                n_images += len(batch)
+                n_bytes += client.last_payload_size
+        elapsed = time.perf_counter() - start
+        results[transport.value] = {
+            "images_per_second": round(n_images / elapsed, 2),
+            "payload_kb_per_image": round(n_bytes / n_images / 1024, 2),
+        }
+        print(f"{transport.value:<5} {results[transport.value]}")
+    return results
+
+
 def test_iris_model():
     """
       Test the iris model
     :return:
     """
-    url = "http://127.0.0.1:8082/invocations"
     labels = ["setosa", "versicolor", "virginica"]
-
-    payload = json.dumps({
-        "instances": [{
+    with ModelClient("http://127.0.0.1:8082") as client:
+        predictions = client.predict_records([{
             "sepal length (cm)": 5,
             "sepal width (cm)": 3.2,
             "petal length (cm)": 1.2,
             "petal width (cm)": 0.2
-        }]
-    })
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    response = requests.request("POST", url, headers=headers, data=payload)
-    response_json = response.json()
-    predictions = response_json["predictions"]
+        }])
     class_index = predictions[0]
     print(f"Predicted class: {labels[class_index]}")
 
@@ -35,30 +181,34 @@ def test_flowers_model():
     Test the flowers model
     :return:
     """
-    image_path = "sunflowers.jpg"
-    image = Image.open(image_path)
-    image = image.resize((180, 180))
-    image_arr = np.array(image) / 255.0
+    image_arr = load_image("sunflowers.jpg")
     labels = ["daisy", "dandelion", "roses", "sunflowers", "tulips"]
 
-    url = "http://127.0.0.1:8081/invocations"
-    payload = json.dumps({
-        "instances": [image_arr.tolist()]
-    })
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    response = requests.request("POST", url, headers=headers, data=payload)
-    response_json = response.json()
-    print(response_json)
-    predictions = response_json["predictions"]
+    with ModelClient("http://127.0.0.1:8081") as client:
+        predictions = client.predict_images([image_arr], transport=Transport.json)
     print(predictions)
-    # softmax = np.exp(predictions) / np.sum(np.exp(predictions), axis=1)
     argmax = np.argmax(predictions, axis=1)
     class_index = argmax[0]
     print(labels[class_index])
 
 
+def benchmark_flowers_model():
+    """
+    Compare the JSON-list transport (keras model, port 8081) against the
+    binary transports (image model, port 8083)
+    :return:
+    """
+    images = [load_image("sunflowers.jpg")] * 32
+    json_client = ModelClient("http://127.0.0.1:8081")
+    binary_client = ModelClient("http://127.0.0.1:8083")
+    benchmark({
+        Transport.json: json_client,
+        Transport.npy: binary_client,
+        Transport.jpeg: binary_client,
+    }, images, batch_size=8)
+
+
 if __name__ == '__main__':
     # test_iris_model()
     test_flowers_model()
+    # benchmark_flowers_model()
@@ -0,0 +1,191 @@
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mlflow
+from mlflow.entities import Metric, Param, RunTag
+from mlflow.tracking import MlflowClient
+
+# limits of a single log_batch request of the tracking server
+MAX_METRICS_PER_BATCH = 1000
+MAX_PARAMS_PER_BATCH = 100
+MAX_TAGS_PER_BATCH = 100
+
+
+class RunLogger:
+    """
+    Log to an MLflow run without a round trip to the tracking server for every call.
+    Params, metrics and tags are buffered and sent with log_batch, when the buffer is
+    full, every flush_interval seconds or when the logger is closed. Figures, artifacts
+    and models are uploaded by background threads. Use it as a context manager inside
+    the run, everything is flushed and uploaded when it exits:
+
+        with mlflow.start_run(), RunLogger() as logger:
+            logger.log_metric("accuracy", 0.9)
+            logger.log_figure(fig, "confusion_matrix.png")
+    """
+
+    def __init__(self, run_id=None, flush_interval=10.0, upload_workers=2):
+        if run_id is None:
+            active_run = mlflow.active_run()
+            if active_run is None:
+                raise RuntimeError("Start an MLflow run or pass the run_id of the run to log to")
+            run_id = active_run.info.run_id
+        self.run_id = run_id
+        self.client = MlflowClient()
+        self.flush_interval = flush_interval
+        self.metrics = []
+        self.params = []
+        self.tags = []
+        self.lock = threading.Lock()
+        self.uploads = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix="mlflow-upload")
+        self.pending = []
+        self.tmp_dir = tempfile.mkdtemp(prefix="mlflow-upload-")
+        # time the training code spent blocked in the logger, and time spent uploading in background
+        self.blocking_time = 0.0
+        self.background_time = 0.0
+        self.closed = False
+        self.stop_flushing = threading.Event()
+        self.flusher = threading.Thread(target=self.__flush_periodically, daemon=True)
+        self.flusher.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def log_param(self, key, value):
+        self.log_params({key: value})
+
+    def log_params(self, params):
+        with self.lock:
+            self.params.extend(Param(key, str(value)) for key, value in params.items())
+            full = len(self.params) >= MAX_PARAMS_PER_BATCH
+        if full:
+            self.flush()
+
+    def set_tag(self, key, value):
+        with self.lock:
+            self.tags.append(RunTag(key, str(value)))
+            full = len(self.tags) >= MAX_TAGS_PER_BATCH
+        if full:
+            self.flush()
+
+    def log_metric(self, key, value, step=0):
+        self.log_metrics({key: value}, step=step)
+
+    def log_metrics(self, metrics, step=0):
+        timestamp = int(time.time() * 1000)
+        with self.lock:
+            self.metrics.extend(Metric(key, float(value), timestamp, step) for key, value in metrics.items())
+            full = len(self.metrics) >= MAX_METRICS_PER_BATCH
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Send the buffered params, metrics and tags with as few log_batch calls as the server limits allow
+        """
+        start = time.perf_counter()
+        with self.lock:
+            metrics, params, tags = self.metrics, self.params, self.tags
+            self.metrics, self.params, self.tags = [], [], []
+        try:
+            while metrics or params or tags:
+                self.client.log_batch(self.run_id,
+                                      metrics=metrics[:MAX_METRICS_PER_BATCH],
+                                      params=params[:MAX_PARAMS_PER_BATCH],
+                                      tags=tags[:MAX_TAGS_PER_BATCH])
+                metrics = metrics[MAX_METRICS_PER_BATCH:]
+                params = params[MAX_PARAMS_PER_BATCH:]
+                tags = tags[MAX_TAGS_PER_BATCH:]
+        except Exception:
+            # put back what wasn't sent so the next flush retries it
+            with self.lock:
+                self.metrics[:0], self.params[:0], self.tags[:0] = metrics, params, tags
+            raise
+        finally:
+            self.__add_blocking_time(start)
+
+    def log_artifact(self, local_path, artifact_path=None):
+        """
+        Upload a file in background, the file must not change until the logger is closed
+        """
+        self.__submit(self.client.log_artifact, self.run_id, local_path, artifact_path)
+
+    def log_figure(self, figure, artifact_file):
+        """
+        Render a matplotlib figure now (matplotlib isn't thread safe) and upload it in background
+        """
+        import matplotlib.pyplot as plt
+        start = time.perf_counter()
+        local_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        local_path = os.path.join(local_dir, os.path.basename(artifact_file))
+        figure.savefig(local_path)
+        plt.close(figure)
+        self.__add_blocking_time(start)
+        self.__submit(self.client.log_artifact, self.run_id, local_path, os.path.dirname(artifact_file) or None)
+
+    def log_sklearn_model(self, model, artifact_path, signature=None):
+        """
+        Log a sklearn model in background, like mlflow.sklearn.log_model: the MLmodel file
+        records the run_id and artifact_path and the model is added to the
+        mlflow.log-model.history tag of the run. The model must not change until the logger is closed
+        """
+        from mlflow.models import Model
+        # the active run is per thread, the run is passed explicitly
+        self.__submit(Model.log, artifact_path, mlflow.sklearn,
+                      run_id=self.run_id, sk_model=model, signature=signature)
+
+    def close(self):
+        """
+        Flush the buffers, wait for the uploads and log the time the logging added to the run
+        """
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self.stop_flushing.set()
+        self.flusher.join()
+        start = time.perf_counter()
+        self.uploads.shutdown(wait=True)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.__add_blocking_time(start)
+        self.log_metrics({"logging_blocking_seconds": self.blocking_time,
+                          "logging_background_seconds": self.background_time})
+        self.flush()
+        print(f"[mlflow] logging added {self.blocking_time:.2f}s to the run "
+              f"({self.background_time:.2f}s of uploads ran in background)")
+        # surface the failed uploads once everything else is logged
+        for future in self.pending:
+            future.result()
+
+    def __submit(self, fn, *args, **kwargs):
+        def upload():
+            start = time.perf_counter()
+            try:
+                fn(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.background_time += time.perf_counter() - start
+        self.pending.append(self.uploads.submit(upload))
+
+    def __flush_periodically(self):
+        while not self.stop_flushing.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                # the buffers are sent again by the final flush
+                print(f"[mlflow] periodic flush failed: {e}")
+
+    def __add_blocking_time(self, start):
+        # the periodic flush runs in its own thread and doesn't block the training
+        if threading.current_thread() is not self.flusher:
+            with self.lock:
+                self.blocking_time += time.perf_counter() - start
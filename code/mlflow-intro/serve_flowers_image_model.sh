@@ -0,0 +1,8 @@
+MODEL_NAME=flowers-classification-image-model
+MODEL_VERSION=1
+
+export MLFLOW_TRACKING_URI=http://0.0.0.0:4001
+# the model is downloaded once to the local artifact cache, restarts serve it from the disk.
+# It is leased to this shell, which exec's into the server, so it isn't evicted while served
+MODEL_PATH=$(python model-registry.py --fetch models:/$MODEL_NAME/$MODEL_VERSION --lease-pid $$) || exit 1
+exec mlflow models serve --model-uri "$MODEL_PATH" -p 8083 --no-conda
@@ -0,0 +1,207 @@
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import mlflow
+
+# environment variables read by the numerical libraries to size their thread pools
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                   "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS"]
+
+
+class MedianStoppingRule:
+    """
+    Stop a trial when its metric at a step is clearly worse than the median of the
+    other trials at the same step, after a few grace steps to let it warm up
+    """
+
+    def __init__(self, mode="max", grace_steps=3, min_trials=2, margin=0.0):
+        self.mode = mode
+        self.grace_steps = grace_steps
+        self.min_trials = min_trials
+        self.margin = margin
+
+    def should_stop(self, step, value, others):
+        """
+        :param step:
+        :param value: metric of the trial at this step
+        :param others: metrics of the other trials at this step
+        :return:
+        """
+        if step < self.grace_steps or len(others) < self.min_trials:
+            return False
+        others = sorted(others)
+        middle = len(others) // 2
+        median = others[middle] if len(others) % 2 else (others[middle - 1] + others[middle]) / 2
+        if self.mode == "max":
+            return value < median - self.margin
+        return value > median + self.margin
+
+
+class TrialReporter:
+    """
+    Handed to each trial to report its intermediate metric and ask whether it should stop.
+    The histories of all the trials live in a dict shared between the worker processes
+    """
+
+    def __init__(self, name, histories, stopping_rule=None):
+        self.name = name
+        self.histories = histories
+        self.stopping_rule = stopping_rule
+        self.stopped_early = False
+
+    def report(self, step, value):
+        """
+        Record the metric of a step and return True when the trial should stop
+        :param step:
+        :param value:
+        :return:
+        """
+        history = self.histories.get(self.name, [])
+        history.append(float(value))
+        # proxies of a shared dict only see the changes made by assigning the whole value
+        self.histories[self.name] = history
+        if self.stopping_rule is None:
+            return False
+        others = [values[step] for name, values in self.histories.items()
+                  if name != self.name and len(values) > step]
+        self.stopped_early = self.stopping_rule.should_stop(step, float(value), others)
+        if self.stopped_early:
+            print(f"[{self.name}] stopped early at step {step}: {value:.4f} vs {others}")
+        return self.stopped_early
+
+
+def _init_worker(cpu_slots):
+    """
+    Pin the worker process to its own share of the cores
+    """
+    cpus = cpu_slots.get()
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+
+
+def _run_trial(trial_fn, name, params, tracking_uri, experiment_id, parent_run_id, histories, stopping_rule):
+    """
+    Run a trial in a worker process, in its own MLflow run nested under the parent run
+    """
+    mlflow.set_tracking_uri(tracking_uri)
+    reporter = TrialReporter(name, histories, stopping_rule)
+    start = time.perf_counter()
+    result = {"name": name, "params": params, "status": "finished", "metrics": {}}
+    with mlflow.start_run(experiment_id=experiment_id, run_name=name,
+                          tags={"mlflow.parentRunId": parent_run_id}) as run:
+        result["run_id"] = run.info.run_id
+        mlflow.log_params({"trial": name, **params})
+        try:
+            result["metrics"] = trial_fn(params, reporter) or {}
+        except Exception:
+            result["status"] = "failed"
+            result["error"] = traceback.format_exc()
+            mlflow.set_tag("trial_error", result["error"][-5000:])
+        result["stopped_early"] = reporter.stopped_early
+        mlflow.set_tag("stopped_early", reporter.stopped_early)
+    result["duration_s"] = round(time.perf_counter() - start, 2)
+    return result
+
+
+class TrialScheduler:
+    """
+    Run the trials of an experiment concurrently in a pool of worker processes.
+    Each trial gets cpus_per_trial cores (its worker is pinned to them and the
+    numerical libraries size their thread pools accordingly) and logs to its own
+    MLflow run nested under the active run. Trials that report an intermediate
+    metric are stopped early by the stopping rule when they are clearly losing.
+    """
+
+    def __init__(self, max_parallel=None, cpus_per_trial=None, stopping_rule=None):
+        num_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+        if cpus_per_trial is None:
+            cpus_per_trial = max(1, num_cpus // (max_parallel or num_cpus))
+        self.cpus_per_trial = cpus_per_trial
+        self.max_parallel = max_parallel or max(1, num_cpus // cpus_per_trial)
+        self.stopping_rule = stopping_rule
+        self.num_cpus = num_cpus
+
+    def cpu_slots(self, num_workers):
+        """
+        Disjoint sets of cores, one per worker, empty sets when there are not enough cores
+        """
+        if hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = list(range(self.num_cpus))
+        if num_workers * self.cpus_per_trial > len(cpus):
+            return [set() for _ in range(num_workers)]
+        return [set(cpus[i * self.cpus_per_trial:(i + 1) * self.cpus_per_trial]) for i in range(num_workers)]
+
+    def run(self, trial_fn, trials):
+        """
+        Run trial_fn(params, reporter) for each (name, params) of trials and return the
+        results sorted by completion. trial_fn must be a module level function so it can
+        be sent to the workers, and returns a dict of the final metrics of the trial.
+        :param trial_fn:
+        :param trials: dict of trial name to parameters
+        :return:
+        """
+        active_run = mlflow.active_run()
+        if active_run is None:
+            raise RuntimeError("Start the parent MLflow run before running the trials")
+        experiment_id = active_run.info.experiment_id
+        tracking_uri = mlflow.get_tracking_uri()
+        num_workers = min(self.max_parallel, len(trials))
+
+        # spawned workers inherit the environment, set the thread budget before starting them
+        previous_env = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+        os.environ.update({var: str(self.cpus_per_trial) for var in THREAD_ENV_VARS})
+        context = get_context("spawn")
+        results = []
+        try:
+            with context.Manager() as manager:
+                histories = manager.dict()
+                cpu_slots = manager.Queue()
+                for cpus in self.cpu_slots(num_workers):
+                    cpu_slots.put(cpus)
+                with ProcessPoolExecutor(max_workers=num_workers, mp_context=context,
+                                         initializer=_init_worker, initargs=(cpu_slots,)) as pool:
+                    futures = [pool.submit(_run_trial, trial_fn, name, params, tracking_uri, experiment_id,
+                                           active_run.info.run_id, histories, self.stopping_rule)
+                               for name, params in trials.items()]
+                    for future in as_completed(futures):
+                        result = future.result()
+                        print(f"trial {result['name']} {result['status']} in {result['duration_s']}s: "
+                              f"{result['metrics']}")
+                        results.append(result)
+        finally:
+            for var, value in previous_env.items():
+                if value is None:
+                    os.environ.pop(var, None)
+                else:
+                    os.environ[var] = value
+        return results
+
+
+def summarize_trials(results, metric, mode="max"):
+    """
+    Print the trials ranked by metric, log the summary to the active run and return the best trial
+    :param results:
+    :param metric:
+    :param mode:
+    :return:
+    """
+    missing = float("-inf") if mode == "max" else float("inf")
+    ranked = sorted(results, key=lambda r: r["metrics"].get(metric, missing), reverse=(mode == "max"))
+    print(f"{'trial':<30} {'status':<10} {'early stop':<11} {metric:<15} {'time (s)':<8}")
+    for result in ranked:
+        value = result["metrics"].get(metric)
+        value = f"{value:.4f}" if value is not None else "-"
+        print(f"{result['name']:<30} {result['status']:<10} {str(result['stopped_early']):<11} "
+              f"{value:<15} {result['duration_s']:<8}")
+    mlflow.log_dict({"metric": metric, "trials": ranked}, "trials_summary.json")
+    best = ranked[0] if ranked and metric in ranked[0]["metrics"] else None
+    if best is not None:
+        mlflow.log_metric(f"best_{metric}", best["metrics"][metric])
+        mlflow.set_tag("best_trial", best["name"])
+        mlflow.set_tag("best_run_id", best["run_id"])
+    return best
@@ -1,29 +1,211 @@
-from fastapi import FastAPI
+import os
+import json
+import time
+import hashlib
+import asyncio
+import traceback
+import tempfile
+from functools import partial
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 from contextlib import asynccontextmanager
-from models import IrisModel, FlowersModel, Framework
+from models import IrisModel, FlowersModel, Framework, InferencePath
+from batching import MicroBatcher
+from executor import InferenceExecutor, ExecutorKind, ExecutorSaturated
+from model_garden import ModelGarden
+from cache import PredictionCache
+from registry import RegistryModel, RegistryWatcher, parse_registry_models
+import metrics
 from users_api import router as users_router
 from iris_model_api import router as iris_model_router
 from flowers_model_api import router as flowers_model_router
 
+# inference path used by the flowers model, "compiled" (tf.function) or "keras" (model.predict)
+FLOWERS_INFERENCE_PATH = InferencePath[os.environ.get("FLOWERS_INFERENCE_PATH", "compiled")]
+# dynamic batching is opt-in, set ENABLE_BATCHING=1 to turn it on
+ENABLE_BATCHING = os.environ.get("ENABLE_BATCHING", "0") == "1"
+# max batch size and max wait time (in milliseconds) for each model in the model garden
+BATCHING_CONFIG = {
+    "iris-model": {"max_batch_size": 256, "max_wait_ms": 2.0},
+    "flowers-model": {"max_batch_size": 16, "max_wait_ms": 10.0},
+}
+# inference pool for each model in the model garden, requests beyond
+# max_workers + max_queue are rejected with a 503
+EXECUTOR_CONFIG = {
+    "iris-model": {"kind": ExecutorKind.thread, "max_workers": 2, "max_queue": 64},
+    "flowers-model": {"kind": ExecutorKind.thread, "max_workers": 1, "max_queue": 16},
+}
+# batch sizes run through each model when it is loaded, before it gets traffic
+WARMUP_BATCH_SIZES = {
+    model_name: (1, config["max_batch_size"]) if ENABLE_BATCHING else (1,)
+    for model_name, config in BATCHING_CONFIG.items()
+}
+# where the traced serving functions are cached between restarts, empty to disable it
+SERVING_CACHE_DIR = os.environ.get("SERVING_CACHE_DIR", os.path.join(tempfile.gettempdir(), "model-garden-serving-cache")) or None
+# how each model is built, the model path and version can be passed to load another version
+MODEL_BUILDERS = {
+    "iris-model": partial(IrisModel,
+                          framework=Framework.sklearn,
+                          warmup_batch_sizes=WARMUP_BATCH_SIZES["iris-model"]),
+    "flowers-model": partial(FlowersModel,
+                             inference_path=FLOWERS_INFERENCE_PATH,
+                             warmup_batch_sizes=WARMUP_BATCH_SIZES["flowers-model"],
+                             serving_cache_dir=SERVING_CACHE_DIR),
+}
+# factories used by the model garden to load each model (name, version) on first use,
+# and to build a copy of the model inside each worker of a process pool
+MODEL_FACTORIES = {
+    ("iris-model", 1): MODEL_BUILDERS["iris-model"],
+    ("flowers-model", 1): MODEL_BUILDERS["flowers-model"],
+}
+# models served from an alias of the MLflow model registry instead of the local models,
+# "garden-name=registered-name@alias" comma separated, e.g.
+# "flowers-model=flowers-classification-model@production". The tracking server is MLFLOW_TRACKING_URI
+REGISTRY_MODELS = os.environ.get("REGISTRY_MODELS", "")
+# seconds between two polls of the aliases, a new version is swapped in without downtime
+REGISTRY_POLL_INTERVAL = float(os.environ.get("REGISTRY_POLL_INTERVAL", 30))
+# the downloaded model versions are kept in the artifact cache shared with the mlflow-intro scripts,
+# ARTIFACT_CACHE_DIR (~/.cache/mlflow-artifacts by default) and ARTIFACT_CACHE_SIZE_MB are read by artifact_cache
+# models loaded and warmed up in the background at startup, comma separated, "all" (default)
+# or empty to load every model on its first request. /readyz reports ready once all of them are warm
+PRELOAD_MODELS = os.environ.get("PRELOAD_MODELS", "all")
+# models loaded by the serve.py master process before forking the workers, shared by all of them
+PREFORK_MODELS = dict()
+# budget of resident models, least recently used idle models are evicted above it
+MODEL_GARDEN_MAX_MODELS = int(os.environ.get("MODEL_GARDEN_MAX_MODELS", 0)) or None
+MODEL_GARDEN_MAX_MEMORY_MB = int(os.environ.get("MODEL_GARDEN_MAX_MEMORY_MB", 0)) or None
+# load every model at startup and report its load time, see profiler.py
+PROFILE_STARTUP = os.environ.get("PROFILE_STARTUP", "0") == "1"
+# size and time to live (seconds) of the prediction cache, a size of 0 disables it
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 10000))
+PREDICTION_CACHE_TTL = float(os.environ.get("PREDICTION_CACHE_TTL", 3600)) or None
+# how long clients may reuse the metadata of a model (seconds) before revalidating it
+METADATA_MAX_AGE = int(os.environ.get("METADATA_MAX_AGE", 300))
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Load the ML model
     print("here you should add the code you want to run when the app is starting")
-    print("Loading the ML models.....")
-    # create a dictionary to save a ref to the registered models (model garden)
-    app.state.model_garden = dict()
+    print("Registering the ML models.....")
+    # create the model garden, models are only loaded when they are first used
+    app.state.model_garden = ModelGarden(
+        max_models=MODEL_GARDEN_MAX_MODELS,
+        max_memory_bytes=MODEL_GARDEN_MAX_MEMORY_MB * 1024 * 1024 if MODEL_GARDEN_MAX_MEMORY_MB else None
+    )
+
+    # models that follow an alias of the model registry
+    registry_models = parse_registry_models(REGISTRY_MODELS)
 
     # register models in the model garden
-    iris_model = IrisModel(framework=Framework.sklearn)
-    flowers_model = FlowersModel()
+    for (model_name, version), factory in MODEL_FACTORIES.items():
+        if model_name in registry_models:
+            # the local model is only the fallback of a registry model until the first poll,
+            # version 0 never collides with a registry version
+            app.state.model_garden.register(model_name, partial(factory, version=0), version=0)
+            continue
+        app.state.model_garden.register(model_name, factory, version=version,
+                                        model=PREFORK_MODELS.get((model_name, version)))
+
+    # follow the aliases of the model registry, the first poll is part of the preload
+    app.state.registry_watcher = None
+    if registry_models:
+        app.state.registry_watcher = RegistryWatcher(
+            app.state.model_garden,
+            [RegistryModel(name, registered_name, alias, MODEL_BUILDERS[name])
+             for name, (registered_name, alias) in registry_models.items()],
+            poll_interval=REGISTRY_POLL_INTERVAL,
+            on_swap=partial(on_model_swap, app)
+        )
+
+    # preload the models, the app only reports ready once they are loaded and warmed up
+    if PROFILE_STARTUP or PRELOAD_MODELS == "all":
+        preload_models = app.state.model_garden.names()
+    else:
+        preload_models = [name.strip() for name in PRELOAD_MODELS.split(",") if name.strip()]
+    app.state.ready = asyncio.Event()
+    app.state.preload_error = None
+    if PROFILE_STARTUP:
+        await preload(app, preload_models, verbose=True)
+    else:
+        app.state.preload_task = asyncio.create_task(preload(app, preload_models))
 
-    app.state.model_garden["iris-model"] = iris_model
-    app.state.model_garden["flowers-model"] = flowers_model
+    # cache the predictions of repeated images and feature vectors
+    app.state.prediction_cache = None
+    if PREDICTION_CACHE_SIZE > 0:
+        app.state.prediction_cache = PredictionCache(max_entries=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL)
+
+    # create the inference pool of each model
+    app.state.executors = dict()
+    for model_name, config in EXECUTOR_CONFIG.items():
+        app.state.executors[model_name] = InferenceExecutor(
+            model_name,
+            model_factory=app.state.model_garden.entry(model_name).factory,
+            **config
+        )
+
+    # put a batcher in front of each model when batching is enabled
+    app.state.batchers = dict()
+    if ENABLE_BATCHING:
+        for model_name, config in BATCHING_CONFIG.items():
+            batcher = MicroBatcher(model_name,
+                                   executor=app.state.executors[model_name],
+                                   **config)
+            await batcher.start()
+            app.state.batchers[model_name] = batcher
 
     yield  
     # Clean up the ML models and release the resources
     print("here you should add the code you want to run when the app is shutting down")
+    if getattr(app.state, "preload_task", None) is not None:
+        app.state.preload_task.cancel()
+    if app.state.registry_watcher is not None:
+        await app.state.registry_watcher.stop()
+    for batcher in app.state.batchers.values():
+        await batcher.stop()
+    for executor in app.state.executors.values():
+        executor.shutdown()
+
+async def preload(app: FastAPI, model_names: list, verbose: bool = False):
+    """
+    Load and warm up the models, then mark the app as ready. A model that fails
+    to load is logged and reported by /readyz, the app never turns ready.
+    """
+    watcher = app.state.registry_watcher
+    if watcher is not None:
+        # serve the versions the aliases point to from the start
+        await watcher.poll()
+        await watcher.start()
+    for model_name in model_names:
+        try:
+            await app.state.model_garden.get(model_name)
+        except Exception as e:
+            app.state.preload_error = f"{model_name}: {type(e).__name__}: {e}"
+            traceback.print_exc()
+            print(f"Preloading {model_name} failed, the app won't report ready")
+            return
+        if verbose:
+            entry = app.state.model_garden.entry(model_name)
+            print(f"Loaded {model_name} v{entry.version} in {entry.load_time:.3f}s ({entry.memory_bytes / 1024 / 1024:.1f} MB)")
+    app.state.ready.set()
+
+def on_model_swap(app: FastAPI, model_name: str, version: int):
+    """
+    Process pools hold their own copy of the model, replace the pool of a swapped
+    model and let the previous one finish its calls in the background
+    """
+    executor = getattr(app.state, "executors", {}).get(model_name)
+    if executor is None or executor.kind != ExecutorKind.process:
+        return
+    app.state.executors[model_name] = InferenceExecutor(
+        model_name,
+        model_factory=app.state.model_garden.entry(model_name).factory,
+        **EXECUTOR_CONFIG[model_name]
+    )
+    batcher = app.state.batchers.get(model_name)
+    if batcher is not None:
+        batcher.executor = app.state.executors[model_name]
+    executor.shutdown(drain=True)
 
 # creating the API
 app = FastAPI(lifespan=lifespan)
@@ -31,10 +213,118 @@ app.include_router(users_router, prefix="/users")
 app.include_router(iris_model_router, prefix="/iris-model")
 app.include_router(flowers_model_router, prefix="/flowers-model")
 
+# routers reported in the request metrics, other paths are grouped together
+METRICS_ROUTERS = ("/iris-model", "/flowers-model", "/users")
+
+class RequestMetricsMiddleware:
+    """
+    Record the duration, status and count of the requests, until the last byte of the response is sent.
+    A plain ASGI middleware: @app.middleware("http") wraps the request body in a way that
+    /flowers-model/predict/stream never receives it once its response has started
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope["path"]
+        router = next((prefix for prefix in METRICS_ROUTERS if path.startswith(prefix)), "other")
+        metrics.REQUESTS_IN_FLIGHT.inc(router=router)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_recording_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_recording_status)
+        finally:
+            metrics.REQUEST_DURATION.observe(time.perf_counter() - start, router=router)
+            metrics.REQUESTS_TOTAL.inc(router=router, method=scope["method"], status=status)
+            metrics.REQUESTS_IN_FLIGHT.dec(router=router)
+
+app.add_middleware(RequestMetricsMiddleware)
+
+# reject the request when the inference pool of the model is full
+@app.exception_handler(ExecutorSaturated)
+async def executor_saturated_handler(request: Request, exc: ExecutorSaturated):
+    return JSONResponse(status_code=503, content={"message": str(exc)}, headers={"Retry-After": "1"})
+
 # creating global routes
 @app.get("/")
 async def root():
     return {"message": "Welcome to the models API"}
 
+# liveness, the process is up and serving requests
+@app.get("/healthz")
+async def healthz():
+    return {"status": "alive"}
+
+# readiness, the preloaded models are loaded and warmed up
+@app.get("/readyz")
+async def readyz():
+    if app.state.preload_error is not None:
+        return JSONResponse(status_code=503, content={"status": "failed", "error": app.state.preload_error})
+    if not app.state.ready.is_set():
+        return JSONResponse(status_code=503, content={"status": "loading"})
+    return {"status": "ready"}
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/models")
+async def models_status():
+    return app.state.model_garden.status()
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    """
+    Whether an If-None-Match header ("*" or a comma separated list of entity tags) matches etag,
+    with the weak comparison of RFC 9110: W/"x" matches "x"
+    """
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.removeprefix("W/") == etag.removeprefix("W/"):
+            return True
+    return False
+
+# the metadata only changes with the model version, clients revalidate it with the ETag.
+# It is described without loading the model
+@app.get("/models/{model_name}/metadata")
+async def model_metadata(request: Request, model_name: str):
+    if model_name not in app.state.model_garden:
+        raise HTTPException(status_code=404, detail=f"Model '{model_name}' not found")
+    content = app.state.model_garden.entry(model_name).metadata()
+    body = json.dumps(content, sort_keys=True, separators=(",", ":")).encode()
+    etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={METADATA_MAX_AGE}"}
+    if etag_matches(etag, request.headers.get("if-none-match", "")):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/registry/status")
+async def registry_status():
+    watcher = app.state.registry_watcher
+    return watcher.status() if watcher is not None else {"enabled": False}
+
+@app.get("/batching/stats")
+async def batching_stats():
+    return {model_name: batcher.stats.to_dict() for model_name, batcher in app.state.batchers.items()}
+
+@app.get("/cache/stats")
+async def cache_stats():
+    cache = app.state.prediction_cache
+    return cache.stats() if cache is not None else {"enabled": False}
+
+@app.get("/executors/stats")
+async def executors_stats():
+    return {model_name: executor.stats() for model_name, executor in app.state.executors.items()}
+
 
 
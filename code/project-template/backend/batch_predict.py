@@ -0,0 +1,272 @@
+"""
+Offline batch inference with the models of the model garden, without going
+through the API. Run it from the backend folder:
+
+    python batch_predict.py images/ predictions/                     # flowers model over a folder of images
+    python batch_predict.py samples.csv predictions/                 # iris model over a CSV or Parquet file
+    python batch_predict.py images/ predictions/ --workers 4 --batch-size 64
+
+Inputs are split in chunks of --batch-size items. While a chunk goes through the
+model, the next ones are read and decoded by a pool of threads, so decoding
+overlaps inference. Each chunk is written as its own Parquet file in the output
+folder, and a run that is restarted skips the chunks that are already written.
+The output folder can be read back as a single table with pyarrow.parquet.read_table.
+
+Parquet support needs pyarrow (pip install pyarrow).
+"""
+import argparse
+import json
+import os
+import time
+import typing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+
+from models import IRIS_FEATURES, Model, softmax
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp"}
+TABLE_EXTENSIONS = {".csv", ".parquet", ".pq"}
+MANIFEST_FILE = "_manifest.json"
+
+
+class ImageSource:
+    """
+    Folder of images scored by the flowers model, the id of each image is its relative path
+    """
+    model_name = "flowers-model"
+
+    def __init__(self, path: typing.Union[str, Path]):
+        self.path = Path(path)
+        self.ids = sorted(str(p.relative_to(self.path)) for p in self.path.rglob("*")
+                          if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS)
+
+    def load(self, model: Model, start: int, stop: int):
+        """
+        Read and decode the images of a chunk, the ones that can't be decoded are reported as errors
+        """
+        from preprocessing import decode_image
+        height, width = model.target_size
+        images = np.empty((stop - start, height, width, 3), dtype=np.float32)
+        errors: typing.List[typing.Optional[str]] = []
+        for i, image_id in enumerate(self.ids[start:stop]):
+            try:
+                decode_image((self.path / image_id).read_bytes(), model.target_size, out=images[i])
+                errors.append(None)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+        return images, errors
+
+    def score(self, model: Model, images: np.ndarray) -> np.ndarray:
+        return softmax(model.forward(images))
+
+
+class TableSource:
+    """
+    CSV or Parquet file of iris samples, one row per sample, the id of each sample is its row number
+    """
+    model_name = "iris-model"
+
+    def __init__(self, path: typing.Union[str, Path]):
+        self.path = Path(path)
+        missing = [name for name in IRIS_FEATURES if name not in self.columns()]
+        if missing:
+            raise ValueError(f"Missing features {missing} in '{self.path}'")
+        if self.path.suffix.lower() == ".csv":
+            from pyarrow import csv
+            table = csv.read_csv(self.path, convert_options=csv.ConvertOptions(include_columns=IRIS_FEATURES))
+        else:
+            import pyarrow.parquet as pq
+            table = pq.read_table(self.path, columns=IRIS_FEATURES)
+        self.features = np.column_stack([table.column(name).to_numpy().astype(np.float32)
+                                         for name in IRIS_FEATURES])
+        self.ids = [str(i) for i in range(len(self.features))]
+
+    def columns(self) -> typing.List[str]:
+        """
+        Column names of the file, read from the CSV header or the Parquet schema without reading the rows
+        """
+        if self.path.suffix.lower() == ".csv":
+            import csv
+            with open(self.path, newline="") as f:
+                return next(csv.reader(f), [])
+        import pyarrow.parquet as pq
+        return pq.read_schema(self.path).names
+
+    def load(self, model: Model, start: int, stop: int):
+        features = self.features[start:stop]
+        errors = [None if ok else "Missing feature value" for ok in np.isfinite(features).all(axis=1)]
+        return features, errors
+
+    def score(self, model: Model, features: np.ndarray) -> np.ndarray:
+        return model.predict_scores(features)
+
+
+def open_source(path: typing.Union[str, Path]) -> typing.Union[ImageSource, TableSource]:
+    path = Path(path)
+    if path.is_dir():
+        return ImageSource(path)
+    if path.suffix.lower() in TABLE_EXTENSIONS:
+        return TableSource(path)
+    raise ValueError(f"Expected a folder of images or a {'/'.join(sorted(TABLE_EXTENSIONS))} file, got '{path}'")
+
+
+def chunk_path(output_dir: Path, chunk: int) -> Path:
+    return output_dir / f"part-{chunk:06d}.parquet"
+
+
+def check_manifest(output_dir: Path, manifest: dict, overwrite: bool):
+    """
+    Make sure a resumed run uses the same input and chunking as the one that wrote the output folder
+    """
+    manifest_path = output_dir / MANIFEST_FILE
+    if manifest_path.exists() and not overwrite:
+        previous = json.loads(manifest_path.read_text())
+        if previous != manifest:
+            raise ValueError(f"'{output_dir}' holds the predictions of another run "
+                             f"({previous}), use --overwrite to start from scratch")
+        return
+    if overwrite:
+        for part in output_dir.glob("part-*.parquet"):
+            part.unlink()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+
+
+def write_chunk(output_dir: Path, chunk: int, model: Model, ids: typing.List[str],
+                probs: np.ndarray, errors: typing.List[typing.Optional[str]]):
+    """
+    Write the predictions of a chunk, through a temporary file so an interrupted
+    run never leaves a partial chunk that a resumed run would skip
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    failed = np.array([error is not None for error in errors])
+    probs = probs.astype(np.float32)
+    probs[failed] = np.nan
+    best = probs.argmax(axis=1) if len(probs) else np.zeros(0, dtype=int)
+    columns = {
+        "id": pa.array(ids, pa.string()),
+        "predicted_class": pa.array([None if fail else model.classes[i] for i, fail in zip(best, failed)],
+                                    pa.string()),
+        "probability": pa.array(np.take_along_axis(probs, best[:, None], axis=1)[:, 0], mask=failed),
+    }
+    for i, class_name in enumerate(model.classes):
+        columns[class_name] = pa.array(probs[:, i], mask=failed)
+    columns["error"] = pa.array(errors, pa.string())
+
+    path = chunk_path(output_dir, chunk)
+    tmp_path = path.with_name(path.name + f".tmp-{os.getpid()}")
+    pq.write_table(pa.table(columns), tmp_path)
+    os.replace(tmp_path, path)
+
+
+def run_chunks(input_path: str, output_dir: str, chunks: typing.List[int], batch_size: int,
+               prefetch: int, worker: int = 0, intra_op_threads: typing.Optional[int] = None) -> int:
+    """
+    Load the model and score the given chunks, decoding the next `prefetch` chunks
+    in background threads while the current one goes through the model.
+    Return the number of items scored.
+    """
+    import api
+    source = open_source(input_path)
+    version = max(v for name, v in api.MODEL_FACTORIES if name == source.model_name)
+    factory = api.MODEL_FACTORIES[(source.model_name, version)]
+    if intra_op_threads and source.model_name == "flowers-model":
+        # share the cores between the workers instead of every worker using all of them
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    model = factory()
+    output_dir = Path(output_dir)
+
+    scored = 0
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=prefetch) as pool:
+        pending = deque()
+        todo = iter(chunks)
+
+        def submit_next():
+            chunk = next(todo, None)
+            if chunk is not None:
+                start, stop = chunk * batch_size, min((chunk + 1) * batch_size, len(source.ids))
+                pending.append((chunk, start, stop, pool.submit(source.load, model, start, stop)))
+
+        for _ in range(prefetch + 1):
+            submit_next()
+        while pending:
+            chunk, start, stop, future = pending.popleft()
+            data, errors = future.result()
+            submit_next()
+            valid = np.array([error is None for error in errors])
+            probs = np.full((len(errors), len(model.classes)), np.nan, dtype=np.float32)
+            if valid.any():
+                probs[valid] = source.score(model, data[valid])
+            write_chunk(output_dir, chunk, model, source.ids[start:stop], probs, errors)
+            scored += stop - start
+            elapsed = time.perf_counter() - start_time
+            print(f"[worker {worker}] chunk {chunk} done, {scored} items in {elapsed:.1f}s "
+                  f"({scored / elapsed:.1f} items/s)", flush=True)
+    return scored
+
+
+def batch_predict(input_path: str, output_dir: str, batch_size: int = 32, workers: int = 1,
+                  prefetch: int = 2, overwrite: bool = False) -> int:
+    """
+    Score every item of input_path and write the predictions in output_dir, resuming a previous run.
+    Return the number of items scored by this run.
+    """
+    source = open_source(input_path)
+    output_dir = Path(output_dir)
+    manifest = {
+        "input": str(Path(input_path).resolve()),
+        "model": source.model_name,
+        "items": len(source.ids),
+        "batch_size": batch_size,
+    }
+    check_manifest(output_dir, manifest, overwrite)
+
+    num_chunks = (len(source.ids) + batch_size - 1) // batch_size
+    chunks = [chunk for chunk in range(num_chunks) if not chunk_path(output_dir, chunk).exists()]
+    print(f"{len(source.ids)} items in {num_chunks} chunks, {num_chunks - len(chunks)} already done")
+    if not chunks:
+        return 0
+
+    if workers <= 1:
+        return run_chunks(input_path, str(output_dir), chunks, batch_size, prefetch)
+
+    # every worker process loads its own model and scores an interleaved share of the chunks.
+    # spawn rather than fork, TensorFlow can't be used in a forked process
+    intra_op_threads = max(1, (os.cpu_count() or 1) // workers)
+    run = partial(run_chunks, input_path, str(output_dir), batch_size=batch_size,
+                  prefetch=prefetch, intra_op_threads=intra_op_threads)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+        futures = [pool.submit(run, chunks[i::workers], worker=i) for i in range(workers) if chunks[i::workers]]
+        return sum(future.result() for future in futures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline batch inference with the model garden models")
+    parser.add_argument("input", type=str, help="folder of images (flowers model) or CSV/Parquet file (iris model)")
+    parser.add_argument("output", type=str, help="folder where the Parquet predictions are written")
+    parser.add_argument("--batch-size", type=int, default=32, help="items scored per model call and per output file")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, each with its own copy of the model")
+    parser.add_argument("--prefetch", type=int, default=2, help="chunks decoded ahead of the model in each worker")
+    parser.add_argument("--overwrite", action="store_true", help="discard the predictions of a previous run")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        scored = batch_predict(args.input, args.output, batch_size=args.batch_size, workers=args.workers,
+                               prefetch=args.prefetch, overwrite=args.overwrite)
+    except ValueError as e:
+        parser.error(str(e))
+    elapsed = time.perf_counter() - start
+    print(f"scored {scored} items in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import asyncio
+import time
+import typing
+from collections import Counter, deque
+
+import numpy as np
+from executor import InferenceExecutor, ExecutorSaturated
+from models import Model
+
+
+class BatchStats:
+    """
+    Keep track of the batch sizes and the time requests spend waiting in the queue
+    """
+    def __init__(self, window: int = 10000):
+        self.batch_sizes = Counter()
+        self.queue_waits = deque(maxlen=window)
+        self.total_requests = 0
+        self.total_batches = 0
+
+    def record(self, batch_size: int, waits: typing.List[float]):
+        self.batch_sizes[batch_size] += 1
+        self.queue_waits.extend(waits)
+        self.total_requests += batch_size
+        self.total_batches += 1
+
+    def to_dict(self) -> dict:
+        waits_ms = np.array(self.queue_waits, dtype=np.float64) * 1000.0
+        if len(waits_ms) == 0:
+            waits_ms = np.zeros(1)
+        return {
+            "total_requests": self.total_requests,
+            "total_batches": self.total_batches,
+            "mean_batch_size": round(self.total_requests / max(self.total_batches, 1), 3),
+            "batch_size_histogram": {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            "queue_wait_ms": {
+                "mean": round(float(waits_ms.mean()), 3),
+                "p50": round(float(np.percentile(waits_ms, 50)), 3),
+                "p99": round(float(np.percentile(waits_ms, 99)), 3),
+                "max": round(float(waits_ms.max()), 3),
+            },
+        }
+
+
+class MicroBatcher:
+    """
+    Gather concurrent requests for a model into a single batch. A batch is
+    dispatched as soon as it holds max_batch_size inputs or the oldest input
+    has waited max_wait_ms, whichever happens first. Batches run on the
+    executor of the model, at most one per executor worker at a time.
+    Each input runs on the model its caller holds, so during a swap a
+    batch is split between the two versions.
+    """
+    def __init__(self,
+                 model_name: str,
+                 executor: InferenceExecutor,
+                 max_batch_size: int = 32,
+                 max_wait_ms: float = 5.0,
+                 max_queue: int = 1024
+                 ):
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue = max_queue
+        self.executor = executor
+        self.stats = BatchStats()
+        self._queue: typing.Optional[asyncio.Queue] = None
+        self._worker: typing.Optional[asyncio.Task] = None
+        self._slots: typing.Optional[asyncio.Semaphore] = None
+        self._dispatching: typing.Set[asyncio.Task] = set()
+
+    async def start(self):
+        """
+        Start the background task that builds and runs the batches
+        """
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._slots = asyncio.Semaphore(self.executor.max_workers)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stop the background task
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def submit(self, x: typing.Any, model: Model) -> typing.Any:
+        """
+        Queue a single input and wait for its own row of the batch class probabilities.
+        The caller holds the model (ModelGarden.use) until the result is back.
+        """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((x, model, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            raise ExecutorSaturated(self.model_name)
+        return await future
+
+    async def _next_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # skip the requests whose callers already went away
+        return [item for item in batch if not item[2].done()]
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                continue
+            await self._slots.acquire()
+            task = asyncio.create_task(self._dispatch(batch))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, batch: list):
+        dispatched_at = time.perf_counter()
+        self.stats.record(len(batch), [dispatched_at - t for _, _, _, t in batch])
+        groups: typing.Dict[int, list] = dict()
+        for item in batch:
+            groups.setdefault(id(item[1]), []).append(item)
+        try:
+            for group in groups.values():
+                await self._run_group(group)
+        finally:
+            self._slots.release()
+
+    async def _run_group(self, group: list):
+        """
+        Run the inputs of a batch that share the same model. If the batch fails,
+        the inputs are run one by one so a broken input only fails its own request.
+        """
+        model = group[0][1]
+        try:
+            outputs = await self.executor.run(model, "predict_scores", [x for x, _, _, _ in group])
+        except Exception as e:
+            if len(group) == 1 or isinstance(e, ExecutorSaturated):
+                for _, _, future, _ in group:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            for item in group:
+                if not item[2].done():
+                    await self._run_group([item])
+            return
+        for (_, _, future, _), output in zip(group, outputs):
+            if not future.done():
+                future.set_result(output)
@@ -0,0 +1,123 @@
+"""
+Micro-benchmarks for the model garden, run them from the backend folder:
+
+    python benchmark.py inference-path --batch-sizes 1 8 32
+    python benchmark.py preprocessing --image photo.jpg
+"""
+import argparse
+import time
+import typing
+
+import numpy as np
+
+
+def time_it(fn: typing.Callable, repeats: int, warmup: int = 3) -> dict:
+    """
+    Call fn several times and return the latency statistics in milliseconds
+    """
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000.0)
+    timings = np.array(timings)
+    return {
+        "mean_ms": round(float(timings.mean()), 3),
+        "p50_ms": round(float(np.percentile(timings, 50)), 3),
+        "p99_ms": round(float(np.percentile(timings, 99)), 3),
+    }
+
+
+def bench_inference_path(args):
+    """
+    Compare keras model.predict against the compiled tf.function path of the flowers model
+    """
+    import tensorflow as tf
+    from models import FlowersModel, InferencePath
+
+    model = FlowersModel()
+    height, width = model.target_size
+    for batch_size in args.batch_sizes:
+        img_tensor = tf.random.uniform((batch_size, height, width, 3), dtype=tf.float32)
+        for inference_path in InferencePath:
+            model.inference_path = inference_path
+            stats = time_it(lambda: model.forward(img_tensor), args.repeats)
+            print(f"batch_size={batch_size:<4} path={inference_path.name:<9} {stats}")
+
+
+def keras_processing_input(image_bytes: bytes, target_size: typing.Tuple[int, int]):
+    """
+    Original preprocessing of the flowers model, kept as the baseline of the benchmark
+    """
+    import tensorflow as tf
+    from io import BytesIO
+
+    image_stream = BytesIO(image_bytes)
+    resized_image = tf.keras.preprocessing.image.load_img(image_stream, target_size=target_size)
+    image_arr = tf.keras.preprocessing.image.img_to_array(resized_image)
+    img_tensor = tf.convert_to_tensor(image_arr)
+    img_tensor = tf.expand_dims(img_tensor, 0)
+    img_tensor = tf.divide(img_tensor, 255.0)
+    return img_tensor
+
+
+def synthetic_jpeg(width: int, height: int) -> bytes:
+    """
+    Encode a random image as JPEG, used when no image is given to the benchmark
+    """
+    from io import BytesIO
+    from PIL import Image as PILImage
+
+    rng = np.random.default_rng(0)
+    # smooth noise compresses like a photo, white noise would not
+    small = rng.integers(0, 256, size=(height // 16, width // 16, 3), dtype=np.uint8)
+    image = PILImage.fromarray(small).resize((width, height), PILImage.BILINEAR)
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def bench_preprocessing(args):
+    """
+    Compare the keras load_img preprocessing against the draft-mode decode of preprocessing.py
+    """
+    from preprocessing import decode_batch
+
+    if args.image:
+        with open(args.image, "rb") as f:
+            image_bytes = f.read()
+    else:
+        image_bytes = synthetic_jpeg(4032, 3024)  # 12-MP phone photo
+    target_size = (180, 180)
+    print(f"image size: {len(image_bytes) / 1024:.1f} KB")
+    for batch_size in args.batch_sizes:
+        batch = [image_bytes] * batch_size
+        baseline = time_it(lambda: [keras_processing_input(b, target_size) for b in batch], args.repeats)
+        fast = time_it(lambda: decode_batch(batch, target_size), args.repeats)
+        print(f"batch_size={batch_size:<4} keras={baseline}")
+        print(f"batch_size={batch_size:<4} fast ={fast}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Model garden benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parser_path = subparsers.add_parser("inference-path", help=bench_inference_path.__doc__.strip())
+    parser_path.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser_path.add_argument("--repeats", type=int, default=50)
+    parser_path.set_defaults(func=bench_inference_path)
+
+    parser_pre = subparsers.add_parser("preprocessing", help=bench_preprocessing.__doc__.strip())
+    parser_pre.add_argument("--image", type=str, default=None, help="JPEG to decode, a synthetic 12-MP one by default")
+    parser_pre.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser_pre.add_argument("--repeats", type=int, default=20)
+    parser_pre.set_defaults(func=bench_preprocessing)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import hashlib
+import time
+import typing
+from collections import OrderedDict
+
+import numpy as np
+
+
+def content_key(x: typing.Any, decimals: int = 3) -> typing.Hashable:
+    """
+    Build the cache key of a model input: a hash of the bytes for images,
+    the features rounded to a number of decimals for feature vectors
+    """
+    if isinstance(x, (bytes, bytearray, memoryview)):
+        return hashlib.blake2b(x, digest_size=16).hexdigest()
+    return tuple(np.round(np.asarray(x, dtype=np.float64), decimals).tolist())
+
+
+class PredictionCache:
+    """
+    LRU cache of the class probabilities predicted for an input, bounded by
+    max_entries and with entries expiring after ttl seconds. Entries are keyed
+    by model name, model version and content key. All the entries of a model
+    are dropped as soon as a newer version of the model is seen, and lookups
+    and stores for older versions, from requests still in flight on the
+    previous version during a swap, are ignored.
+    """
+    def __init__(self, max_entries: int = 10000, ttl: typing.Optional[float] = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: typing.OrderedDict[tuple, typing.Tuple[float, np.ndarray]] = OrderedDict()
+        self.versions: typing.Dict[str, int] = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __check_version(self, model_name: str, version: int) -> bool:
+        """
+        Return False for a version older than the newest one seen for the model
+        """
+        latest = self.versions.get(model_name, version)
+        if version < latest:
+            return False
+        if version > latest:
+            self.invalidate(model_name)
+        self.versions[model_name] = version
+        return True
+
+    def get(self, model_name: str, version: int, key: typing.Hashable) -> typing.Optional[np.ndarray]:
+        if not self.__check_version(model_name, version):
+            self.misses += 1
+            return None
+        cache_key = (model_name, version, key)
+        entry = self.entries.get(cache_key)
+        if entry is None:
+            self.misses += 1
+            return None
+        stored_at, value = entry
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            del self.entries[cache_key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(cache_key)
+        self.hits += 1
+        return value
+
+    def put(self, model_name: str, version: int, key: typing.Hashable, value: np.ndarray):
+        if not self.__check_version(model_name, version):
+            return
+        cache_key = (model_name, version, key)
+        self.entries[cache_key] = (time.monotonic(), value)
+        self.entries.move_to_end(cache_key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, model_name: str):
+        """
+        Drop all the entries of a model
+        """
+        for cache_key in [k for k in self.entries if k[0] == model_name]:
+            del self.entries[cache_key]
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
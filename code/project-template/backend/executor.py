@@ -0,0 +1,102 @@
+import asyncio
+import typing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from enum import Enum, auto
+
+from models import Model
+
+
+class ExecutorKind(Enum):
+    thread = auto()
+    process = auto()
+
+
+class ExecutorSaturated(Exception):
+    """
+    Raised when an inference executor has no free worker and its queue is full
+    """
+    def __init__(self, model_name: str):
+        super().__init__(f"Inference executor for '{model_name}' is saturated")
+        self.model_name = model_name
+
+
+# model instance owned by each worker of a process pool
+_worker_model: typing.Optional[Model] = None
+
+
+def _init_worker(model_factory: typing.Callable[[], Model]):
+    global _worker_model
+    _worker_model = model_factory()
+
+
+def _call_worker_model(method_name: str, *args):
+    return getattr(_worker_model, method_name)(*args)
+
+
+class InferenceExecutor:
+    """
+    Run the blocking model calls in a bounded pool so they don't stall the event loop.
+    Thread pools call the model loaded by the app; process pools build their own copy
+    of the model in every worker using model_factory, which must be picklable.
+    """
+    def __init__(self,
+                 model_name: str,
+                 kind: ExecutorKind = ExecutorKind.thread,
+                 max_workers: int = 1,
+                 max_queue: int = 16,
+                 model_factory: typing.Optional[typing.Callable[[], Model]] = None
+                 ):
+        self.model_name = model_name
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.in_flight = 0
+
+        if kind == ExecutorKind.thread:
+            self.pool = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix=f"{model_name}-inference")
+        elif kind == ExecutorKind.process:
+            if model_factory is None:
+                raise ValueError("A model_factory is required to run the model in a process pool")
+            self.pool = ProcessPoolExecutor(max_workers=max_workers,
+                                            initializer=_init_worker,
+                                            initargs=(model_factory,))
+        else:
+            raise ValueError(f"Executor kind {kind} not supported")
+
+    @property
+    def saturated(self) -> bool:
+        return self.in_flight >= self.max_workers + self.max_queue
+
+    async def run(self, model: Model, method_name: str, *args) -> typing.Any:
+        """
+        Call a method of the model in the pool, e.g. run(model, "predict", X)
+        """
+        if self.saturated:
+            raise ExecutorSaturated(self.model_name)
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        try:
+            if self.kind == ExecutorKind.thread:
+                return await loop.run_in_executor(self.pool, getattr(model, method_name), *args)
+            return await loop.run_in_executor(self.pool, _call_worker_model, method_name, *args)
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind.name,
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+        }
+
+    def shutdown(self, drain: bool = False):
+        """
+        Stop the pool, cancelling the queued calls. With drain=True it returns at
+        once and the calls already submitted still complete before the workers exit.
+        """
+        if drain:
+            self.pool.shutdown(wait=False)
+        else:
+            self.pool.shutdown(wait=True, cancel_futures=True)
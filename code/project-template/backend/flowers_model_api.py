@@ -1,13 +1,24 @@
-from fastapi import APIRouter, Request
+import asyncio
+import json
+import typing
+from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import JSONResponse
-from fastapi import UploadFile, Form, File
+from fastapi import UploadFile, Form, File, Query
 from typing import Optional
-from PIL import Image as PILImage
-from io import BytesIO
-import tensorflow as tf
-from models import Model, Framework
-from keras.models import Sequential
-import keras.layers as layers
+import inference
+import metrics
+from executor import ExecutorSaturated
+from streaming import iter_multipart_files, iter_tar_files, DuplexStreamingResponse, FileTooLarge
+
+# images scored together by the streaming endpoint
+STREAM_BATCH_SIZE = 16
+# images received but not scored yet, the upload is paused when it is full
+STREAM_QUEUE_SIZE = 2 * STREAM_BATCH_SIZE
+STREAM_MAX_IMAGE_SIZE = 20 * 1024 * 1024
+# attempts to score a batch while the inference executor is saturated, waiting twice as long
+# after each of them, before its images get an error record
+STREAM_SATURATED_RETRIES = 5
+STREAM_SATURATED_BACKOFF = 0.05
 
 router = APIRouter()
 
@@ -21,11 +32,116 @@ async def hi_model():
 async def predict(request: Request, 
                   image: UploadFile = File(...),
         lat: Optional[float] = Form(default=None),
-        lng: Optional[float] = Form(default=None)):
-    image_bytes: bytes = await image.read() # read the image as bytes
+        lng: Optional[float] = Form(default=None),
+        top_k: Optional[int] = Query(default=None, ge=1),
+        columnar: bool = Query(default=False)):
+    with metrics.MODEL_STAGE_DURATION.time(model="flowers-model", stage="upload_read"):
+        image_bytes: bytes = await image.read() # read the image as bytes
     # with open("image.jpg", "wb") as f:
     #     f.write(image_bytes)
-    model_garden = request.app.state.model_garden
-    flowers_model = model_garden["flowers-model"]
-    predictions = flowers_model.predict(image_bytes)
-    return JSONResponse(content={"predictions": predictions})
\ No newline at end of file
+    predictions = await inference.predict(request.app.state, "flowers-model", image_bytes,
+                                          top_k=top_k, columnar=columnar)
+    return JSONResponse(content={"predictions": predictions})
+
+
+async def score_stream_batch(app_state, batch: list, top_k: Optional[int]) -> typing.List[str]:
+    """
+    Score a batch of (index, filename, image bytes) and return one NDJSON line per image.
+    If the batch fails, the images are scored one by one so a broken image only fails itself.
+    While the executor is saturated the batch is retried with a backoff, the upload stays paused
+    meanwhile, and if it is still saturated after STREAM_SATURATED_RETRIES the images get an error record.
+    """
+    images = [content for _, _, content in batch]
+    for attempt in range(STREAM_SATURATED_RETRIES + 1):
+        try:
+            probs = await inference.run(app_state, "flowers-model", "predict_scores", images)
+            break
+        except ExecutorSaturated as e:
+            if attempt == STREAM_SATURATED_RETRIES:
+                return [json.dumps({"index": index, "filename": filename, "error": str(e)}) + "\n"
+                        for index, filename, _ in batch]
+            await asyncio.sleep(STREAM_SATURATED_BACKOFF * 2 ** attempt)
+        except Exception:
+            if len(batch) == 1:
+                index, filename, _ = batch[0]
+                return [json.dumps({"index": index, "filename": filename, "error": "Invalid image"}) + "\n"]
+            lines = []
+            for item in batch:
+                lines += await score_stream_batch(app_state, [item], top_k)
+            return lines
+
+    model = await app_state.model_garden.get("flowers-model")
+    outputs = model.format_outputs(probs, top_k=top_k)
+    return [json.dumps({"index": index, "filename": filename, "predictions": output}) + "\n"
+            for (index, filename, _), output in zip(batch, outputs)]
+
+
+async def stream_predictions(app_state, files: typing.AsyncIterator, top_k: Optional[int]) -> typing.AsyncIterator[str]:
+    """
+    Read the uploaded images in a background task while the received ones are
+    scored in batches, and yield the results as soon as each batch is done.
+    An image that is too large gets an error record, the ones after it are still scored.
+    """
+    queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    done = object()
+
+    async def read_files():
+        try:
+            index = 0
+            async for filename, content in files:
+                await queue.put((index, filename, content))
+                index += 1
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await queue.put(done)
+
+    reader = asyncio.create_task(read_files())
+    try:
+        finished = False
+        while not finished:
+            item = await queue.get()
+            batch = []
+            skipped = None
+            while True:
+                if item is done:
+                    finished = True
+                    break
+                if isinstance(item, Exception):
+                    yield json.dumps({"error": str(item)}) + "\n"
+                    finished = True
+                    break
+                index, filename, content = item
+                if isinstance(content, FileTooLarge):
+                    # ends the batch, its record goes after the images received before it
+                    skipped = json.dumps({"index": index, "filename": filename, "error": str(content)}) + "\n"
+                    break
+                batch.append(item)
+                if len(batch) >= STREAM_BATCH_SIZE or queue.empty():
+                    break
+                item = queue.get_nowait()
+            if batch:
+                for line in await score_stream_batch(app_state, batch, top_k):
+                    yield line
+            if skipped is not None:
+                yield skipped
+    finally:
+        reader.cancel()
+
+
+@router.post("/predict/stream")
+async def predict_stream(request: Request, top_k: Optional[int] = Query(default=None, ge=1)):
+    """
+    Score many images uploaded in a single request, as multipart/form-data
+    (one file part per image) or as an uncompressed tar (application/x-tar).
+    Results are streamed back as newline-delimited JSON while the upload goes on.
+    """
+    from multipart.multipart import parse_options_header
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type == b"multipart/form-data" and b"boundary" in options:
+        files = iter_multipart_files(request.stream(), options[b"boundary"], STREAM_MAX_IMAGE_SIZE)
+    elif content_type == b"application/x-tar":
+        files = iter_tar_files(request.stream(), STREAM_MAX_IMAGE_SIZE)
+    else:
+        raise HTTPException(status_code=415, detail="Expected a multipart/form-data or application/x-tar upload")
+    return DuplexStreamingResponse(stream_predictions(request.app.state, files, top_k), media_type="application/x-ndjson")
@@ -0,0 +1,43 @@
+import typing
+
+import numpy as np
+from cache import content_key
+import metrics
+
+
+async def run(app_state, model_name: str, method_name: str, *args) -> typing.Any:
+    """
+    Call a method of a model from the model garden on the inference executor of the model
+    """
+    async with app_state.model_garden.use(model_name) as model:
+        return await app_state.executors[model_name].run(model, method_name, *args)
+
+
+async def predict(app_state,
+                  model_name: str,
+                  x: typing.Any,
+                  top_k: typing.Optional[int] = None,
+                  columnar: bool = False
+                  ) -> typing.Union[typing.List[dict], dict]:
+    """
+    Make a prediction for a single input, through the batcher of the model when batching is enabled.
+    Inputs already seen by the current version of the model are served from the prediction cache.
+    The model is resolved once, the cache key, the inference and the outputs all use the same
+    version even when a swap happens in the middle of the request.
+    """
+    cache = app_state.prediction_cache
+    async with app_state.model_garden.use(model_name) as model:
+        key = content_key(x) if cache is not None else None
+        scores = cache.get(model_name, model.version, key) if cache is not None else None
+
+        if scores is None:
+            batcher = app_state.batchers.get(model_name)
+            if batcher is not None:
+                scores = await batcher.submit(x, model)
+            else:
+                scores = (await app_state.executors[model_name].run(model, "predict_scores", [x]))[0]
+            if cache is not None:
+                cache.put(model_name, model.version, key, scores)
+
+        with metrics.MODEL_STAGE_DURATION.time(model=model_name, stage="postprocessing"):
+            return model.format_outputs(np.expand_dims(scores, 0), top_k=top_k, columnar=columnar)
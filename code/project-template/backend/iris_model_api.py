@@ -1,6 +1,17 @@
-from fastapi import APIRouter, Request
-from fastapi.responses import JSONResponse
+import asyncio
+import json
+import time
+from io import BytesIO, StringIO
+from fastapi import APIRouter, Request, Query, HTTPException
+from typing import Optional
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
+import numpy as np
+import inference
+from models import IRIS_FEATURES as FEATURES, Model
+# rows sent to the model in each call of the bulk endpoint
+BULK_CHUNK_SIZE = 50000
+BULK_MAX_ROWS = 5000000
 
 
 # Model entry schema
@@ -23,9 +34,94 @@ async def hi_model():
 
 
 @router.post("/predict")
-async def predict(request: Request, data: IrisModel):
+async def predict(request: Request, data: IrisModel,
+                  top_k: Optional[int] = Query(default=None, ge=1),
+                  columnar: bool = Query(default=False)):
     model_input = data.to_list()
-    model_garden =  request.app.state.model_garden
-    model = model_garden["iris-model"]
-    predictions = model.predict([model_input])
+    predictions = await inference.predict(request.app.state, "iris-model", model_input,
+                                          top_k=top_k, columnar=columnar)
     return JSONResponse(content={"prediction": predictions})
+
+
+
+def parse_bulk_input(body: bytes, content_type: str) -> np.ndarray:
+    """
+    Parse the body of a bulk request into a (n, 4) float array. Supported formats:
+    - application/json: one array per feature, e.g. {"sepal_length": [...], ...}
+    - text/csv: one row per sample, with a header naming the features
+    - application/x-npy: a (n, 4) numpy array saved with np.save
+    Parsing millions of rows takes a while, call it outside of the event loop.
+    """
+    try:
+        if content_type == "application/json":
+            columns = json.loads(body)
+            missing = [name for name in FEATURES if name not in columns]
+            if missing:
+                raise ValueError(f"Missing features {missing}")
+            X = np.column_stack([np.asarray(columns[name], dtype=np.float64) for name in FEATURES])
+        elif content_type == "text/csv":
+            header = body[:body.index(b"\n")].decode().strip() if b"\n" in body else body.decode().strip()
+            names = [name.strip() for name in header.split(",")]
+            missing = [name for name in FEATURES if name not in names]
+            if missing:
+                raise ValueError(f"Missing features {missing} in the CSV header")
+            X = np.loadtxt(BytesIO(body), delimiter=",", skiprows=1, ndmin=2,
+                           usecols=[names.index(name) for name in FEATURES])
+        elif content_type in ("application/x-npy", "application/octet-stream"):
+            X = np.load(BytesIO(body), allow_pickle=False)
+        else:
+            raise HTTPException(status_code=415, detail=f"Content type '{content_type}' not supported")
+        if X.dtype.kind not in "iuf":
+            raise ValueError(f"Expected numbers, got values of type {X.dtype}")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Invalid input: {e}")
+
+    if X.ndim != 2 or X.shape[1] != len(FEATURES):
+        raise HTTPException(status_code=422, detail=f"Expected {len(FEATURES)} features per row, got shape {list(X.shape)}")
+    if X.shape[0] == 0 or X.shape[0] > BULK_MAX_ROWS:
+        raise HTTPException(status_code=422, detail=f"Expected between 1 and {BULK_MAX_ROWS} rows, got {X.shape[0]}")
+    if not np.isfinite(X).all():
+        raise HTTPException(status_code=422, detail="Input contains NaN or infinite values")
+    return X
+
+
+def format_bulk_output(model: Model, probs: np.ndarray, content_type: str) -> Response:
+    """
+    Return the probabilities in the same columnar format as the input
+    """
+    if content_type == "text/csv":
+        buffer = StringIO()
+        np.savetxt(buffer, probs, fmt="%.3f", delimiter=",", header=",".join(model.classes), comments="")
+        return Response(content=buffer.getvalue(), media_type="text/csv")
+    if content_type in ("application/x-npy", "application/octet-stream"):
+        buffer = BytesIO()
+        np.save(buffer, probs.astype(np.float32), allow_pickle=False)
+        return Response(content=buffer.getvalue(), media_type="application/x-npy",
+                        headers={"X-Classes": ",".join(model.classes)})
+    # one row per class of the transposed matrix, i.e. the column of the class
+    columns = model.format_outputs(probs.T, columnar=True)["probabilities"]
+    return JSONResponse(content=dict(zip(model.classes, columns)))
+
+
+@router.post("/predict/bulk")
+async def predict_bulk(request: Request):
+    content_type = request.headers.get("content-type", "application/json").split(";")[0].strip()
+    loop = asyncio.get_running_loop()
+    X = await loop.run_in_executor(None, parse_bulk_input, await request.body(), content_type)
+
+    # the model is resolved once, all the chunks are scored by the same version even during a swap
+    async with request.app.state.model_garden.use("iris-model") as model:
+        start = time.perf_counter()
+        chunks = []
+        for i in range(0, X.shape[0], BULK_CHUNK_SIZE):
+            executor = request.app.state.executors["iris-model"]
+            chunks.append(await executor.run(model, "predict_scores", X[i:i + BULK_CHUNK_SIZE]))
+        probs = np.concatenate(chunks, axis=0)
+        elapsed = time.perf_counter() - start
+        response = await loop.run_in_executor(None, format_bulk_output, model, probs, content_type)
+    response.headers["X-Rows"] = str(X.shape[0])
+    response.headers["X-Inference-Time"] = f"{elapsed:.6f}"
+    response.headers["X-Rows-Per-Second"] = f"{X.shape[0] / max(elapsed, 1e-9):.1f}"
+    return response
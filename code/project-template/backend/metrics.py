@@ -0,0 +1,133 @@
+import bisect
+import threading
+import time
+import typing
+from contextlib import contextmanager
+
+# default latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """
+    Base class of the metrics, each combination of label values is a separate series
+    """
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, label_names: typing.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.series: typing.Dict[tuple, typing.Any] = dict()
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _format_labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.label_names, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> typing.List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            series = list(self.series.items())
+        for key, value in series:
+            lines.extend(self._render_series(key, value))
+        return lines
+
+    def _render_series(self, key: tuple, value: typing.Any) -> typing.List[str]:
+        return [f"{self.name}{self._format_labels(key)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: typing.Sequence[str] = (),
+                 buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                # [bucket counts..., +Inf count], sum
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_series(self, key: tuple, value: typing.Any) -> typing.List[str]:
+        counts, total = value
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            le_label = f'le="{le}"'
+            lines.append(f"{self.name}_bucket{self._format_labels(key, le_label)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+        lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+
+REGISTRY: typing.List[Metric] = []
+
+
+def render() -> str:
+    """
+    Render all the metrics in the Prometheus text exposition format
+    """
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+REQUESTS_TOTAL = Counter("http_requests_total", "Number of HTTP requests", ["router", "method", "status"])
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Latency of the HTTP requests", ["router"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being served", ["router"])
+MODEL_STAGE_DURATION = Histogram("model_stage_duration_seconds", "Time spent in each stage of a prediction",
+                                 ["model", "stage"])
+MODEL_LOAD_DURATION = Gauge("model_load_duration_seconds", "Time it took to load the model", ["model", "version"])
+MODEL_SERVED_VERSION = Gauge("model_served_version", "Version of the model currently served", ["model"])
+REGISTRY_POLL_INTERVAL = Gauge("model_registry_poll_interval_seconds", "Interval between two polls of the model registry", [])
+REGISTRY_POLLS = Counter("model_registry_polls_total", "Polls of the model registry", ["model", "status"])
+REGISTRY_LAST_POLL = Gauge("model_registry_last_poll_timestamp_seconds", "Time of the last successful poll of the model registry", ["model"])
+MODEL_SWAPS = Counter("model_swaps_total", "Swaps of the served model version", ["model", "status"])
+MODEL_SWAP_DURATION = Gauge("model_swap_duration_seconds", "Time to download, load and warm up the new version of a swap", ["model", "version"])
@@ -0,0 +1,213 @@
+import asyncio
+import gc
+import time
+import typing
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from models import Model
+import metrics
+
+
+class ModelEntry:
+    """
+    A model registered in the model garden, loaded only when it is first used
+    """
+    def __init__(self, name: str, version: int, factory: typing.Callable[[], Model]):
+        self.name = name
+        self.version = version
+        self.factory = factory
+        self.model: typing.Optional[Model] = None
+        self.memory_bytes = 0
+        self.load_time = 0.0
+        self.last_used = 0.0
+        self.in_use = 0
+        # pinned entries are never evicted to make room for another model
+        self.pinned = False
+        self.lock = asyncio.Lock()
+
+    @property
+    def key(self) -> typing.Tuple[str, int]:
+        return self.name, self.version
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "version": self.version,
+            "resident": self.model is not None,
+            "memory_bytes": self.memory_bytes,
+            "load_time_s": round(self.load_time, 3),
+            "last_used": self.last_used,
+            "in_use": self.in_use,
+            "pinned": self.pinned,
+        }
+
+    def metadata(self) -> dict:
+        """
+        Metadata of the model, described by the factory without loading the model when it isn't resident
+        """
+        model = self.model if self.model is not None else self.factory(load=False)
+        return model.metadata()
+
+
+class ModelGarden:
+    """
+    Registry of the models served by the API. Models are registered by name and
+    version without being loaded, loaded on first use (concurrent first requests
+    share a single load) and the least recently used idle models are evicted
+    when the garden holds more than max_models models or max_memory_bytes bytes.
+    """
+    def __init__(self,
+                 max_models: typing.Optional[int] = None,
+                 max_memory_bytes: typing.Optional[int] = None
+                 ):
+        self.max_models = max_models
+        self.max_memory_bytes = max_memory_bytes
+        self.entries: typing.Dict[typing.Tuple[str, int], ModelEntry] = dict()
+        self.latest: typing.Dict[str, int] = dict()
+        # resident models, from the least to the most recently used
+        self.resident: typing.OrderedDict[typing.Tuple[str, int], ModelEntry] = OrderedDict()
+        # versions replaced by a swap, waiting for their last request before being dropped
+        self.retiring: typing.Set[asyncio.Task] = set()
+
+    def register(self,
+                 name: str,
+                 factory: typing.Callable[[], Model],
+                 version: int = 1,
+                 model: typing.Optional[Model] = None
+                 ):
+        """
+        Register a model without loading it, or with an already loaded model
+        (e.g. loaded before the workers were forked). The highest registered
+        version is the one served when no version is requested.
+        """
+        entry = ModelEntry(name, version, factory)
+        self.entries[(name, version)] = entry
+        if model is not None:
+            entry.model = model
+            entry.memory_bytes = model.memory_usage()
+            self.resident[entry.key] = entry
+        if version >= self.latest.get(name, version):
+            self.latest[name] = version
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.latest
+
+    def names(self) -> typing.List[str]:
+        return list(self.latest.keys())
+
+    def entry(self, name: str, version: typing.Optional[int] = None) -> ModelEntry:
+        if name not in self.latest:
+            raise KeyError(f"Model '{name}' is not registered in the model garden")
+        version = self.latest[name] if version is None else version
+        if (name, version) not in self.entries:
+            raise KeyError(f"Model '{name}' has no version {version}")
+        return self.entries[(name, version)]
+
+    async def get(self, name: str, version: typing.Optional[int] = None) -> Model:
+        """
+        Return the model, loading it first if it isn't resident
+        """
+        entry = self.entry(name, version)
+        if entry.model is None:
+            async with entry.lock:
+                if entry.model is None:
+                    await self.__load(entry)
+        entry.last_used = time.time()
+        self.resident.move_to_end(entry.key)
+        return entry.model
+
+    @asynccontextmanager
+    async def use(self, name: str, version: typing.Optional[int] = None):
+        """
+        Hold the model while a request uses it so it can't be evicted meanwhile
+        """
+        entry = self.entry(name, version)
+        entry.in_use += 1
+        try:
+            yield await self.get(name, version)
+        finally:
+            entry.in_use -= 1
+
+    async def swap(self, name: str, version: int, factory: typing.Callable[[], Model]) -> ModelEntry:
+        """
+        Load and warm up another version of a model next to the one being served,
+        then serve it. Requests that already hold the previous version finish on it,
+        and the previous version is dropped once the last of them is done. The previous
+        version keeps serving while the new one loads, loading it never evicts it.
+        """
+        previous = self.entry(name)
+        if previous.version == version:
+            return previous
+        entry = ModelEntry(name, version, factory)
+        self.entries[entry.key] = entry
+        previous.pinned = True
+        try:
+            await self.get(name, version)
+        except Exception:
+            del self.entries[entry.key]
+            raise
+        finally:
+            previous.pinned = False
+        # a single assignment, the requests that resolve the model from now on get the new version
+        self.latest[name] = version
+        task = asyncio.create_task(self.__retire(previous))
+        self.retiring.add(task)
+        task.add_done_callback(self.retiring.discard)
+        return entry
+
+    async def __retire(self, entry: ModelEntry, poll_interval: float = 0.05):
+        while entry.in_use > 0:
+            await asyncio.sleep(poll_interval)
+        if entry.model is not None:
+            self.evict(entry.name, entry.version)
+        self.entries.pop(entry.key, None)
+        # free the weights now rather than whenever the next collection runs
+        gc.collect()
+
+    async def __load(self, entry: ModelEntry):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        model = await loop.run_in_executor(None, entry.factory)
+        entry.load_time = time.perf_counter() - start
+        metrics.MODEL_LOAD_DURATION.set(entry.load_time, model=entry.name, version=entry.version)
+        entry.memory_bytes = model.memory_usage()
+        entry.model = model
+        self.resident[entry.key] = entry
+        self.__evict_over_budget(keep=entry)
+
+    def __over_budget(self) -> bool:
+        if self.max_models is not None and len(self.resident) > self.max_models:
+            return True
+        if self.max_memory_bytes is not None and self.memory_usage() > self.max_memory_bytes:
+            return True
+        return False
+
+    def __evict_over_budget(self, keep: ModelEntry):
+        for key in list(self.resident.keys()):
+            if not self.__over_budget():
+                break
+            entry = self.resident[key]
+            if entry is keep or entry.in_use > 0 or entry.pinned:
+                continue
+            self.evict(entry.name, entry.version)
+
+    def evict(self, name: str, version: typing.Optional[int] = None):
+        """
+        Drop the reference to a loaded model so its memory can be released
+        """
+        entry = self.entry(name, version)
+        self.resident.pop(entry.key, None)
+        entry.model = None
+        entry.memory_bytes = 0
+
+    def memory_usage(self) -> int:
+        return sum(entry.memory_bytes for entry in self.resident.values())
+
+    def status(self) -> dict:
+        return {
+            "max_models": self.max_models,
+            "max_memory_bytes": self.max_memory_bytes,
+            "memory_bytes": self.memory_usage(),
+            "models": [entry.to_dict() for entry in self.entries.values()],
+        }
@@ -1,35 +1,78 @@
+import os
+import shutil
+import hashlib
 import numpy as np
+import metrics
 from enum import Enum, auto
 from pathlib import Path
 import typing
 from abc import ABC
 import typing
 
+# input features of the iris model, in the order expected by the model
+IRIS_FEATURES = ["sepal_length", "sepal_width", "petal_length", "petal_width"]
+
 class Framework(Enum):
     tensorflow = auto()
     sklearn = auto()
     pytorch = auto()
 
+class InferencePath(Enum):
+    keras = auto()      # keras model.predict
+    compiled = auto()   # direct call through a traced tf.function
+
+def softmax(scores: np.ndarray) -> np.ndarray:
+    """
+    Row-wise softmax of a score matrix
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    exp_scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+    return exp_scores / exp_scores.sum(axis=1, keepdims=True)
+
+def files_digest(path: typing.Union[str, Path]) -> str:
+    """
+    blake2b of the relative paths and contents of the files of a model, a single file or a folder
+    """
+    path = Path(path)
+    files = [path] if path.is_file() else sorted(p for p in path.rglob("*") if p.is_file())
+    digest = hashlib.blake2b(digest_size=16)
+    for file in files:
+        digest.update(file.relative_to(path).as_posix().encode() + b"\0")
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
 class Model(ABC):
     def __init__(self, 
                  model_name: str,
                  model_path: typing.Union[str, Path], 
                  framework: Framework, 
                  version: int,
-                 classes: typing.List[str]
+                 classes: typing.List[str],
+                 warmup_batch_sizes: typing.Sequence[int] = (1,),
+                 mmap_weights: bool = False,
+                 load: bool = True
                  ):
+        """
+        load=False only describes the model (metadata, input spec) without loading its weights
+        """
         self.model_name = model_name
         self.model_path = model_path
         self.framework = framework
         self.version = version
         self.classes = classes
+        self.warmup_batch_sizes = warmup_batch_sizes
+        self.mmap_weights = mmap_weights
         self.model = None
+        self.warmed_up = False
         
-        self.load()
+        if load:
+            self.load()
 
     def load(self):
         """
-        Load the model from the model_path
+        Load the model from the model_path, prepare its serving path and warm it up
         """
         if self.framework == Framework.sklearn:
             self.__load_sklearn_model()
@@ -37,6 +80,29 @@ class Model(ABC):
             self.__load_tensorflow_model()
         else:
             raise ValueError(f"Framework {self.framework} not supported")
+        self.build_serving_path()
+        self.warmup()
+
+    def build_serving_path(self):
+        """
+        Prepare anything the model needs to serve requests once it is loaded
+        """
+        pass
+
+    def warmup_input(self, batch_size: int) -> typing.Any:
+        """
+        Synthetic input of batch_size samples used to warm up the model
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def warmup(self):
+        """
+        Run synthetic inputs of every warmup batch size through the model, so
+        the first real requests don't pay for the lazy initialisation of the framework
+        """
+        for batch_size in self.warmup_batch_sizes:
+            self.predict_scores(self.warmup_input(batch_size))
+        self.warmed_up = True
 
     def __load_sklearn_model(self):
         """
@@ -52,6 +118,36 @@ class Model(ABC):
         import tensorflow as tf
         self.model = tf.keras.models.load_model(self.model_path)
 
+    def memory_usage(self) -> int:
+        """
+        Approximate memory used by the model weights, in bytes
+        """
+        if self.framework == Framework.tensorflow:
+            return int(sum(np.prod(w.shape) * w.dtype.size for w in self.model.weights))
+        if os.path.isfile(self.model_path):
+            return os.path.getsize(self.model_path)
+        return 0
+
+    def input_spec(self) -> dict:
+        """
+        Description of the input expected by the model, so clients can prepare it on their side
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def metadata(self) -> dict:
+        """
+        Public description of the model served by the API. The preferred batch size
+        is the largest batch the model was warmed up with, the fastest to send at once.
+        """
+        return {
+            "name": self.model_name,
+            "version": self.version,
+            "framework": self.framework.name,
+            "classes": self.classes,
+            "input": self.input_spec(),
+            "preferred_batch_size": max(self.warmup_batch_sizes),
+        }
+
     def __call__(self, X: typing.Any) -> typing.Any:
         return self.predict(X)
 
@@ -60,78 +156,282 @@ class Model(ABC):
         Make a prediction
         """
         raise NotImplementedError("Subclasses must implement this method")
+
+    def predict_scores(self, batch: typing.Any) -> np.ndarray:
+        """
+        Return the class probabilities of a batch of inputs, one row per input
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def predict_batch(self, batch: typing.Any, top_k: typing.Optional[int] = None, columnar: bool = False):
+        """
+        Make a prediction for a batch of inputs in a single call
+        """
+        return self.format_outputs(self.predict_scores(batch), top_k=top_k, columnar=columnar)
+
+    def format_outputs(self,
+                       probs: np.ndarray,
+                       top_k: typing.Optional[int] = None,
+                       columnar: bool = False,
+                       decimals: int = 3
+                       ) -> typing.Union[typing.List[dict], dict]:
+        """
+        Turn a matrix of class probabilities into the response of the model.
+        By default it returns one {class: probability} dict per row, with columnar=True
+        the list of classes and the probability matrix. top_k keeps the k most likely
+        classes of each row, sorted from the most to the least likely.
+        """
+        probs = np.round(np.asarray(probs, dtype=np.float64), decimals)
+        if top_k is None:
+            if columnar:
+                return {"classes": self.classes, "probabilities": probs.tolist()}
+            return [dict(zip(self.classes, row)) for row in probs.tolist()]
+
+        top_k = min(top_k, probs.shape[1])
+        indices = np.argsort(-probs, axis=1, kind="stable")[:, :top_k]
+        top_probs = np.take_along_axis(probs, indices, axis=1).tolist()
+        top_classes = np.asarray(self.classes)[indices].tolist()
+        if columnar:
+            return {"classes": top_classes, "probabilities": top_probs}
+        return [dict(zip(row_classes, row_probs)) for row_classes, row_probs in zip(top_classes, top_probs)]
     
 
 
 class IrisModel(Model):
-    def __init__(self, framework: Framework = Framework.tensorflow):
-        
+    def __init__(self,
+                 framework: Framework = Framework.tensorflow,
+                 warmup_batch_sizes: typing.Sequence[int] = (1,),
+                 model_path: typing.Optional[typing.Union[str, Path]] = None,
+                 version: int = 1,
+                 load: bool = True
+                 ):
+        """
+        model_path and version default to the model shipped with the API, they point
+        to another version of the model when it comes from the model registry
+        """
         if framework == Framework.tensorflow:
-            model_path = "models/iris-model/tf/model"
-            version = 1
+            model_path = model_path or "models/iris-model/tf/model"
         elif framework == Framework.sklearn:
-            model_path = "models/iris-model/sklearn/model.pk"
-            version = 1
+            model_path = model_path or "models/iris-model/sklearn/model.pk"
         else:
             raise ValueError(f"Framework {framework} not supported")
         classes = ["setosa", "versicolor", "virginica"]
         name = "iris-model"
-        super().__init__(name, model_path, framework, version, classes)
+        self.features = IRIS_FEATURES
+        super().__init__(name, model_path, framework, version, classes, warmup_batch_sizes, load=load)
     
     def predict(self, X):
         """
         Make a prediction
         """
-        outputs = []
+        return self.predict_batch(X)
+
+    def warmup_input(self, batch_size: int):
+        return np.zeros((batch_size, 4), dtype=np.float32)
+
+    def input_spec(self) -> dict:
+        return {
+            "kind": "tabular",
+            "shape": [None, len(self.features)],
+            "dtype": "float32",
+            "features": self.features,
+        }
+
+    def predict_scores(self, X):
+        """
+        Return the class probabilities of a batch of feature rows
+        """
         if self.framework == Framework.sklearn:
-            predictions =  self.model.predict_proba(X)
-            for i, xi_probs in enumerate(predictions):
-                outputs.append({self.classes[j]: round(float(xi_probs[j]), 3) for j in range(len(xi_probs))})
+            return self.model.predict_proba(X)
         elif self.framework == Framework.tensorflow:
-            outputs = []
-            predictions =  self.model.predict(X)
-            for i, xi_softmax in enumerate(predictions):
-                outputs.append({self.classes[j]: round(float(xi_softmax[j]), 3) for j in range(len(xi_softmax))})
-        return outputs
+            return self.model.predict(np.asarray(X, dtype=np.float32), verbose=0)
+        raise ValueError(f"Framework {self.framework} not supported")
             
 
 
 class FlowersModel(Model):
-    def __init__(self):
-        model_path = "models/flowers-model/tf/model"
+    def __init__(self,
+                 inference_path: InferencePath = InferencePath.compiled,
+                 warmup_batch_sizes: typing.Sequence[int] = (1,),
+                 serving_cache_dir: typing.Optional[typing.Union[str, Path]] = None,
+                 model_path: typing.Optional[typing.Union[str, Path]] = None,
+                 version: int = 1,
+                 mmap_weights: bool = False,
+                 load: bool = True
+                 ):
+        """
+        mmap_weights serves the model from the memory-mapped weights exported in the
+        serving cache (see shared_weights.py), shared by all the processes serving it
+        """
+        if mmap_weights and (serving_cache_dir is None or inference_path != InferencePath.compiled):
+            raise ValueError("mmap_weights needs a serving_cache_dir and the compiled inference path")
+        model_path = model_path or "models/flowers-model/tf/model"
         framework = Framework.tensorflow
-        version = 1
         classes = ["daisy", "dandelion", "roses", "sunflowers", "tulips"]
         name = "flowers-model"
-        super().__init__(name, model_path, framework, version, classes)
-
         self.target_size = (180, 180)
+        self.inference_path = inference_path
+        self.serving_cache_dir = serving_cache_dir
+        self.serving_fn = None
+        super().__init__(name, model_path, framework, version, classes, warmup_batch_sizes, mmap_weights, load)
+
+    def serving_cache_path(self) -> typing.Optional[Path]:
+        """
+        Folder where the traced serving function of this model version is cached
+        """
+        if self.serving_cache_dir is None:
+            return None
+        import tensorflow as tf
+        height, width = self.target_size
+        # keyed by the content of the weights, a model updated in place gets a new entry
+        key = f"{self.model_name}-v{self.version}-{height}x{width}-tf{tf.__version__}-{files_digest(self.model_path)}"
+        return Path(self.serving_cache_dir) / key
+
+    def shared_weights_path(self) -> Path:
+        cache_path = self.serving_cache_path()
+        return cache_path.with_name(cache_path.name + "-shared")
+
+    def load(self):
+        """
+        With the compiled inference path, restore the serving function from the serving
+        cache when it holds this version of the model. The keras model isn't loaded then,
+        the restored function holds the only copy of the weights.
+        """
+        if self.mmap_weights:
+            from shared_weights import SharedWeightsFunction
+            if not self.shared_weights_path().exists():
+                self.export_shared_weights()
+            self.serving_fn = SharedWeightsFunction(self.shared_weights_path())
+            self.warmup()
+            return
+        cache_path = self.serving_cache_path() if self.inference_path == InferencePath.compiled else None
+        if cache_path is not None and cache_path.exists():
+            import tensorflow as tf
+            self.serving_module = tf.saved_model.load(str(cache_path))
+            self.serving_fn = self.serving_module.serve
+            self.warmup()
+            return
+        super().load()
+
+    def build_serving_path(self):
+        """
+        Wrap the keras model in a tf.function with a fixed input signature. The
+        traced function is saved in the serving cache, so the next start of the
+        same model version restores the graph instead of tracing it again.
+        """
+        if self.inference_path != InferencePath.compiled:
+            return
+        import tensorflow as tf
+        cache_path = self.serving_cache_path()
+        keras_model = self.model
+        serving_fn = self.trace_serving_fn(keras_model)
+        self.serving_fn = serving_fn
+
+        if cache_path is not None:
+            module = tf.Module()
+            module.keras_model = keras_model
+            module.serve = serving_fn
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_name(cache_path.name + f".tmp-{os.getpid()}")
+            tf.saved_model.save(module, str(tmp_path))
+            try:
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                # another worker cached the same version first
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def trace_serving_fn(self, keras_model):
+        """
+        tf.function calling the keras model on a batch of images of the target size
+        """
+        import tensorflow as tf
+        height, width = self.target_size
+
+        @tf.function(input_signature=[tf.TensorSpec(shape=[None, height, width, 3], dtype=tf.float32)])
+        def serving_fn(img_tensor):
+            return keras_model(img_tensor, training=False)
+
+        serving_fn.get_concrete_function()
+        return serving_fn
+
+    def export_shared_weights(self):
+        """
+        Export the serving function with memory-mappable weights, loading the keras model only when needed
+        """
+        from shared_weights import export_shared_weights
+        if self.shared_weights_path().exists():
+            return
+        serving_fn = self.serving_fn
+        if serving_fn is None:
+            import tensorflow as tf
+            serving_fn = self.trace_serving_fn(tf.keras.models.load_model(self.model_path))
+        export_shared_weights(serving_fn, self.shared_weights_path())
+
+    def memory_usage(self) -> int:
+        if self.mmap_weights:
+            # pages of the exported files, shared with the other processes serving the model
+            return self.serving_fn.nbytes
+        if self.model is None:
+            # restored from the serving cache, the weights are the variables of the serving function
+            variables = self.serving_fn.concrete_functions[0].variables
+            return int(sum(v.shape.num_elements() * v.dtype.size for v in variables))
+        return super().memory_usage()
+
+    def warmup_input(self, batch_size: int) -> typing.List[bytes]:
+        from io import BytesIO
+        from PIL import Image as PILImage
+        height, width = self.target_size
+        buffer = BytesIO()
+        PILImage.new("RGB", (width, height)).save(buffer, format="JPEG")
+        return [buffer.getvalue()] * batch_size
+
+    def input_spec(self) -> dict:
+        height, width = self.target_size
+        # images are resized to image_size by the model, clients can resize larger ones before uploading
+        return {
+            "kind": "image",
+            "shape": [None, height, width, 3],
+            "dtype": "float32",
+            "value_range": [0.0, 1.0],
+            "image_size": [height, width],
+            "resize": "bilinear",
+        }
+
+    def forward(self, img_tensor):
+        """
+        Run the model over a batch of preprocessed images using the selected inference path
+        """
+        with metrics.MODEL_STAGE_DURATION.time(model=self.model_name, stage="forward"):
+            if self.inference_path == InferencePath.compiled:
+                return self.serving_fn(img_tensor).numpy()
+            elif self.inference_path == InferencePath.keras:
+                return self.model.predict(img_tensor, verbose=0)
+        raise ValueError(f"Inference path {self.inference_path} not supported")
     
     def processing_input(self, image_bytes:  bytes):
         """
         Preprocess the input image
         """
-        import tensorflow as tf
-        from PIL import Image as PILImage
-        from io import BytesIO
-        
-        image_stream = BytesIO(image_bytes)
-        resized_image = tf.keras.preprocessing.image.load_img(image_stream, target_size=self.target_size)
-        image_arr = tf.keras.preprocessing.image.img_to_array(resized_image)
-        img_tensor = tf.convert_to_tensor(image_arr)
-        img_tensor = tf.expand_dims(img_tensor, 0)
-        img_tensor = tf.divide(img_tensor, 255.0)
-        return img_tensor
+        return self.processing_batch([image_bytes])
+
+    def processing_batch(self, batch: typing.List[bytes]):
+        """
+        Decode, resize and normalize a list of images into a single float32 array
+        """
+        from preprocessing import decode_batch
+        with metrics.MODEL_STAGE_DURATION.time(model=self.model_name, stage="processing_input"):
+            return decode_batch(batch, self.target_size)
     
     def predict(self, image_bytes: bytes):
         """
         Make a prediction
         """
-        import tensorflow as tf
-        img_tensor = self.processing_input(image_bytes)
-        scores = self.model.predict(img_tensor)
-        predictions = tf.nn.softmax(scores)
-        outputs = []
-        for i, xi_softmax in enumerate(predictions):
-            outputs.append({self.classes[j]: round(float(xi_softmax[j]), 3) for j in range(len(xi_softmax))})
-        return outputs
\ No newline at end of file
+        return self.predict_batch([image_bytes])
+
+    def predict_scores(self, batch: typing.List[bytes]) -> np.ndarray:
+        """
+        Return the class probabilities of a list of images in a single forward pass
+        """
+        img_tensor = self.processing_batch(batch)
+        scores = self.forward(img_tensor)
+        return softmax(scores)
@@ -0,0 +1,42 @@
+import typing
+from io import BytesIO
+
+import numpy as np
+from PIL import Image as PILImage
+
+
+def decode_image(image_bytes: bytes,
+                 target_size: typing.Tuple[int, int],
+                 out: typing.Optional[np.ndarray] = None
+                 ) -> np.ndarray:
+    """
+    Decode an image, resize it to target_size (height, width) and scale it to [0, 1].
+    JPEGs are decoded directly at the smallest power-of-two scale that is still
+    larger than the target (PIL draft mode), so a 12-MP photo is never fully decoded.
+    The result is written into out when given, a float32 array of shape (height, width, 3).
+    """
+    height, width = target_size
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.float32)
+
+    image = PILImage.open(BytesIO(image_bytes))
+    image.draft("RGB", (width, height))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if image.size != (width, height):
+        # bilinear, same as the Resizing layer used during training
+        image = image.resize((width, height), PILImage.BILINEAR)
+    # cast and normalize in one pass straight into the output buffer
+    np.multiply(np.asarray(image, dtype=np.uint8), np.float32(1.0 / 255.0), out=out)
+    return out
+
+
+def decode_batch(batch: typing.List[bytes], target_size: typing.Tuple[int, int]) -> np.ndarray:
+    """
+    Decode a list of images into a single float32 array of shape (n, height, width, 3)
+    """
+    height, width = target_size
+    images = np.empty((len(batch), height, width, 3), dtype=np.float32)
+    for i, image_bytes in enumerate(batch):
+        decode_image(image_bytes, target_size, out=images[i])
+    return images
@@ -0,0 +1,86 @@
+"""
+Startup profiler of the backend, run it from the backend folder:
+
+    python profiler.py                 # import time of api.py, per module
+    python profiler.py --load-models   # plus the load time of every model in the model garden
+
+Setting PROFILE_STARTUP=1 also makes the app load every model at startup and print its load time.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import typing
+
+
+def profile_imports(module: str = "api") -> typing.List[dict]:
+    """
+    Import a module in a fresh interpreter with -X importtime and return the
+    import time of every module it pulls in, in seconds
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to import {module}:\n{result.stderr[-2000:]}")
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        timings.append({
+            "module": name.strip(),
+            "depth": (len(name) - len(name.lstrip())) // 2,
+            "self_s": int(self_us) / 1e6,
+            "cumulative_s": int(cumulative_us) / 1e6,
+        })
+    return timings
+
+
+def profile_model_loads(factories: typing.Dict[typing.Tuple[str, int], typing.Callable]) -> typing.List[dict]:
+    """
+    Load every model from its factory and return the load time in seconds
+    """
+    timings = []
+    for (name, version), factory in factories.items():
+        start = time.perf_counter()
+        model = factory()
+        timings.append({
+            "model": name,
+            "version": version,
+            "load_s": time.perf_counter() - start,
+            "memory_bytes": model.memory_usage(),
+        })
+    return timings
+
+
+def print_report(import_timings: typing.List[dict], load_timings: typing.List[dict], top: int = 25):
+    total = sum(t["self_s"] for t in import_timings)
+    print(f"Import time: {total:.3f}s over {len(import_timings)} modules, slowest top-level imports:")
+    top_level = sorted(import_timings, key=lambda t: t["cumulative_s"], reverse=True)
+    top_level = [t for t in top_level if t["depth"] <= 1][:top]
+    for t in top_level:
+        print(f"  {t['cumulative_s']:8.3f}s  (self {t['self_s']:.3f}s)  {t['module']}")
+    if load_timings:
+        print("Model load time:")
+        for t in load_timings:
+            print(f"  {t['load_s']:8.3f}s  {t['memory_bytes'] / 1024 / 1024:8.1f} MB  {t['model']} v{t['version']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backend startup profiler")
+    parser.add_argument("--module", type=str, default="api", help="module to import")
+    parser.add_argument("--top", type=int, default=25, help="number of modules to report")
+    parser.add_argument("--load-models", action="store_true", help="also load every model of the model garden")
+    args = parser.parse_args()
+
+    import_timings = profile_imports(args.module)
+    load_timings = []
+    if args.load_models:
+        from api import MODEL_FACTORIES
+        load_timings = profile_model_loads(MODEL_FACTORIES)
+    print_report(import_timings, load_timings, top=args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import asyncio
+import os
+import time
+import typing
+from functools import partial
+from pathlib import Path
+
+from artifact_cache import ArtifactCache
+from model_garden import ModelGarden
+from models import Model
+import metrics
+
+
+class RegistryModel:
+    """
+    A model of the garden served from the version an alias of the MLflow model registry points to
+    """
+    def __init__(self, name: str, registered_name: str, alias: str, builder: typing.Callable[..., Model]):
+        self.name = name
+        self.registered_name = registered_name
+        self.alias = alias
+        # builds the model from model_path and version
+        self.builder = builder
+        # cached artifacts of the version being served, leased so they aren't evicted while it's served
+        self.model_dir: typing.Optional[Path] = None
+        self.last_poll: typing.Optional[float] = None
+        self.last_error: typing.Optional[str] = None
+        self.swaps = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "registered_name": self.registered_name,
+            "alias": self.alias,
+            "last_poll": self.last_poll,
+            "last_error": self.last_error,
+            "swaps": self.swaps,
+        }
+
+
+def parse_registry_models(spec: str) -> typing.Dict[str, typing.Tuple[str, str]]:
+    """
+    Parse "garden-name=registered-name@alias,..." into {garden name: (registered name, alias)}
+    """
+    models = dict()
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, target = item.split("=", 1)
+        registered_name, alias = target.rsplit("@", 1)
+        models[name.strip()] = (registered_name.strip(), alias.strip())
+    return models
+
+
+def flavor_model_path(model_dir: typing.Union[str, Path]) -> Path:
+    """
+    Path of the native model inside a model downloaded from MLflow, read from the flavors of its MLmodel file
+    """
+    import yaml
+    model_dir = Path(model_dir)
+    with open(model_dir / "MLmodel") as f:
+        flavors = yaml.safe_load(f)["flavors"]
+    if "sklearn" in flavors:
+        return model_dir / flavors["sklearn"]["pickled_model"]
+    for name in ("tensorflow", "keras"):
+        if name in flavors:
+            data = model_dir / flavors[name].get("data", "data")
+            if flavors[name].get("save_format") == "keras":
+                return data / "model.keras"
+            return data / "model"
+    raise ValueError(f"No sklearn or tensorflow flavor in the model {model_dir}")
+
+
+class RegistryWatcher:
+    """
+    Poll the aliases of the MLflow model registry and hot swap the models of the garden
+    when an alias moves to another version. The new version is downloaded, loaded and
+    warmed up in the background while the previous one keeps serving, see ModelGarden.swap.
+    The tracking server is the one of MLFLOW_TRACKING_URI.
+    """
+    def __init__(self,
+                 model_garden: ModelGarden,
+                 models: typing.List[RegistryModel],
+                 poll_interval: float = 30.0,
+                 artifact_cache: typing.Optional[ArtifactCache] = None,
+                 on_swap: typing.Optional[typing.Callable[[str, int], None]] = None
+                 ):
+        from mlflow.tracking import MlflowClient
+        self.model_garden = model_garden
+        self.models = models
+        self.poll_interval = poll_interval
+        # the downloaded versions are kept on disk, a restart doesn't download them again
+        self.artifact_cache = artifact_cache or ArtifactCache()
+        self.on_swap = on_swap
+        self.client = MlflowClient()
+        self.task: typing.Optional[asyncio.Task] = None
+        metrics.REGISTRY_POLL_INTERVAL.set(poll_interval)
+
+    async def start(self):
+        """
+        Poll the registry every poll_interval seconds in a background task
+        """
+        self.task = asyncio.create_task(self.__poll_forever())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def __poll_forever(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.poll()
+
+    async def poll(self):
+        """
+        Swap every model whose alias points to another version than the one being served
+        """
+        for model in self.models:
+            try:
+                await self.__poll_model(model)
+            except Exception as e:
+                model.last_error = f"{type(e).__name__}: {e}"
+                print(f"[registry] {model.name}: {model.last_error}")
+
+    async def __poll_model(self, model: RegistryModel):
+        loop = asyncio.get_running_loop()
+        try:
+            model_version = await loop.run_in_executor(
+                None, self.client.get_model_version_by_alias, model.registered_name, model.alias)
+        except Exception:
+            metrics.REGISTRY_POLLS.inc(model=model.name, status="error")
+            raise
+        metrics.REGISTRY_POLLS.inc(model=model.name, status="ok")
+        model.last_poll = time.time()
+        model.last_error = None
+        metrics.REGISTRY_LAST_POLL.set(model.last_poll, model=model.name)
+
+        version = int(model_version.version)
+        served = self.model_garden.entry(model.name).version
+        metrics.MODEL_SERVED_VERSION.set(served, model=model.name)
+        if version == served:
+            return
+
+        print(f"[registry] {model.registered_name}@{model.alias} moved to version {version}, "
+              f"swapping {model.name} v{served} -> v{version}")
+        start = time.perf_counter()
+        try:
+            model_dir = await loop.run_in_executor(
+                None, partial(self.artifact_cache.model_dir, model_version, lease_pid=os.getpid()))
+        except Exception:
+            metrics.MODEL_SWAPS.inc(model=model.name, status="error")
+            raise
+        try:
+            factory = partial(model.builder, model_path=str(flavor_model_path(model_dir)), version=version)
+            await self.model_garden.swap(model.name, version, factory)
+        except Exception:
+            metrics.MODEL_SWAPS.inc(model=model.name, status="error")
+            if model_dir != model.model_dir:
+                self.artifact_cache.release(model_dir)
+            raise
+        # the garden may evict and reload the model later, the previous version is never reloaded
+        if model.model_dir is not None and model.model_dir != model_dir:
+            self.artifact_cache.release(model.model_dir)
+        model.model_dir = model_dir
+        metrics.MODEL_SWAPS.inc(model=model.name, status="ok")
+        metrics.MODEL_SWAP_DURATION.set(time.perf_counter() - start, model=model.name, version=version)
+        metrics.MODEL_SERVED_VERSION.set(version, model=model.name)
+        model.swaps += 1
+        print(f"[registry] {model.name} now serves v{version} ({time.perf_counter() - start:.2f}s)")
+        if self.on_swap is not None:
+            self.on_swap(model.name, version)
+
+    def status(self) -> dict:
+        return {
+            "poll_interval": self.poll_interval,
+            "artifact_cache": self.artifact_cache.stats(),
+            "models": {model.name: {**model.to_dict(), "served_version": self.model_garden.entry(model.name).version}
+                       for model in self.models},
+        }
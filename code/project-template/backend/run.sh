@@ -18,7 +18,7 @@ if [[ "$(docker images -q $IMAGE_NAME 2> /dev/null)" != "" ]]; then
 fi
 
 # create docker image
-docker build -t $IMAGE_NAME .
+docker build -t $IMAGE_NAME --build-context artifact-cache=../../artifact-cache .
 
 # run the container
 if $RUN_INTERACTIVE; then
@@ -0,0 +1,248 @@
+"""
+Production server of the backend: a master process that loads the shared
+models, then forks several uvicorn workers that accept connections on the
+same listening socket. Run it from the backend folder:
+
+    python serve.py --workers 4 --preload iris-model
+    python serve.py --benchmark --workers 1 2 4   # memory and throughput per worker count
+
+sklearn models are loaded by the master before the fork and shared copy-on-write
+by the workers. TensorFlow can't run in a process forked after it was initialised,
+so the master never imports it: a spawned process exports the serving function of
+each TensorFlow model with its weights as .npy files (see shared_weights.py), and
+every worker memory-maps the same files, so the weights are stored once in the
+file cache whatever the number of workers.
+
+    python serve.py --benchmark --workers 1 2 4 --preload flowers-model --benchmark-model flowers-model
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import typing
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+
+from models import Framework
+
+
+def export_shared_weights(model_name: str, version: int) -> typing.Tuple[str, bool]:
+    """
+    Run in a spawned process: load the model and, for a TensorFlow model that supports
+    it, export its memory-mappable weights. Return the framework and whether they were exported.
+    """
+    import api
+    model = api.MODEL_FACTORIES[(model_name, version)]()
+    if model.framework != Framework.tensorflow:
+        return model.framework.name, False
+    try:
+        model.export_shared_weights()
+    except (AttributeError, ValueError) as e:
+        print(f"[master] {model_name} v{version} can't share its weights ({e}), each worker loads its own copy")
+        return model.framework.name, False
+    return model.framework.name, True
+
+
+def preload_models(model_names: typing.List[str]):
+    """
+    Prepare the models in the master process so the forked workers share their weights
+    """
+    import api
+    context = get_context("spawn")
+    for (model_name, version), factory in list(api.MODEL_FACTORIES.items()):
+        if model_name not in model_names:
+            continue
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            framework, exported = pool.submit(export_shared_weights, model_name, version).result()
+        if framework == Framework.tensorflow.name:
+            if exported:
+                api.MODEL_FACTORIES[(model_name, version)] = partial(factory, mmap_weights=True)
+                print(f"[master] exported the shared weights of {model_name} v{version}")
+            continue
+        model = factory()
+        api.PREFORK_MODELS[(model_name, version)] = model
+        print(f"[master] loaded {model_name} v{version} ({model.memory_usage() / 1024 / 1024:.1f} MB)")
+
+
+def run_worker(sock: socket.socket, log_level: str):
+    import uvicorn
+    import api
+    config = uvicorn.Config(api.app, log_level=log_level)
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+
+def serve(host: str, port: int, workers: int, preload: typing.List[str], log_level: str = "info"):
+    """
+    Bind the socket, preload the shared models and keep `workers` forked workers running
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    preload_models(preload)
+
+    children: typing.Dict[int, int] = dict()
+    stopping = False
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                run_worker(sock, log_level)
+            finally:
+                os._exit(0)
+        children[pid] = index
+        print(f"[master] started worker {index} (pid {pid})")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for index in range(workers):
+        spawn(index)
+
+    # restart the workers that die until the master is asked to stop
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            print(f"[master] worker {index} (pid {pid}) exited, restarting it")
+            spawn(index)
+    sock.close()
+
+
+def process_tree_pss(pid: int) -> int:
+    """
+    Proportional set size of a process and its children in bytes, shared pages
+    are split between the processes that map them so the sum is the real footprint
+    """
+    pids = [pid]
+    children_path = f"/proc/{pid}/task/{pid}/children"
+    if os.path.exists(children_path):
+        with open(children_path) as f:
+            pids += [int(child) for child in f.read().split()]
+    total = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def benchmark_request(model_name: str) -> typing.Tuple[str, bytes, str]:
+    """
+    Path, body and content type of the prediction request sent to a model by the benchmark
+    """
+    if model_name == "flowers-model":
+        from io import BytesIO
+        from PIL import Image
+        image = BytesIO()
+        Image.new("RGB", (320, 240), (200, 120, 40)).save(image, format="JPEG")
+        boundary = "benchmark-boundary"
+        body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"image\"; filename=\"image.jpg\"\r\n"
+                f"Content-Type: image/jpeg\r\n\r\n").encode() + image.getvalue() + f"\r\n--{boundary}--\r\n".encode()
+        return "/flowers-model/predict", body, f"multipart/form-data; boundary={boundary}"
+    payload = {"sepal_length": 5.0, "sepal_width": 3.2, "petal_length": 1.2, "petal_width": 0.2}
+    return "/iris-model/predict", json.dumps(payload).encode(), "application/json"
+
+
+def load_test(url: str, body: bytes, content_type: str, duration: float, concurrency: int) -> float:
+    """
+    Post the body from `concurrency` threads for `duration` seconds and return the requests per second
+    """
+    deadline = time.perf_counter() + duration
+    counts = [0] * concurrency
+
+    def client(i: int):
+        while time.perf_counter() < deadline:
+            request = urllib.request.Request(url, data=body, headers={"Content-Type": content_type})
+            with urllib.request.urlopen(request) as response:
+                response.read()
+            counts[i] += 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(client, range(concurrency)))
+    return sum(counts) / duration
+
+
+def benchmark(worker_counts: typing.List[int], port: int, preload: typing.List[str],
+              model_name: str = "iris-model", duration: float = 10.0, concurrency: int = 32):
+    """
+    Start the server with each worker count and report memory and throughput of the model
+    """
+    url = f"http://127.0.0.1:{port}"
+    path, body, content_type = benchmark_request(model_name)
+    for workers in worker_counts:
+        command = [sys.executable, __file__, "--port", str(port), "--workers", str(workers),
+                   "--log-level", "warning", "--preload", *preload]
+        # every worker loads the model at startup instead of on its first request
+        process = subprocess.Popen(command, env={**os.environ, "PRELOAD_MODELS": model_name})
+        try:
+            for _ in range(600):
+                try:
+                    urllib.request.urlopen(f"{url}/readyz").read()
+                    break
+                except Exception:
+                    time.sleep(0.1)
+            # let every worker finish loading the model before measuring
+            load_test(f"{url}{path}", body, content_type, 5.0, concurrency)
+            rps = load_test(f"{url}{path}", body, content_type, duration, concurrency)
+            pss = process_tree_pss(process.pid)
+            print(f"workers={workers:<3} requests/s={rps:10.1f}  memory (PSS)={pss / 1024 / 1024:8.1f} MB  "
+                  f"per worker={pss / workers / 1024 / 1024:8.1f} MB")
+        finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-worker server of the model garden API")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    parser.add_argument("--workers", type=int, nargs="+", default=[int(os.environ.get("WEB_CONCURRENCY", 2))])
+    parser.add_argument("--preload", type=str, nargs="*", default=["iris-model"],
+                        help="models prepared once by the master and shared by the workers")
+    parser.add_argument("--log-level", type=str, default="info")
+    parser.add_argument("--benchmark", action="store_true", help="report memory and throughput for each --workers value")
+    parser.add_argument("--benchmark-model", type=str, default="iris-model", choices=["iris-model", "flowers-model"],
+                        help="model whose predict endpoint is load tested")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load per benchmark step")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.workers, args.port, args.preload, model_name=args.benchmark_model, duration=args.duration)
+    else:
+        serve(args.host, args.port, args.workers[0], args.preload, log_level=args.log_level)
+
+
+if __name__ == "__main__":
+    main()
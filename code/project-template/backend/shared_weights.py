@@ -0,0 +1,101 @@
+"""
+TensorFlow weights shared between processes through memory-mapped files.
+
+TensorFlow can't run in a process forked after it was initialised, so the
+workers of serve.py can't inherit a model loaded by the master. Instead the
+serving function of the model is exported once as a graph whose weights are
+inputs, next to one .npy file per weight. Every worker memory-maps the same
+files and hands them to TensorFlow through DLPack without copying them, so the
+weights are pages of the OS file cache shared by all the workers.
+
+    <path>/
+        graph.pb         serving graph, the weights are placeholders
+        manifest.json    names of the input, output and weight tensors
+        weights/*.npy    one file per weight
+"""
+import json
+import os
+import shutil
+import typing
+from pathlib import Path
+
+import numpy as np
+
+# constants of the frozen graph with fewer elements stay in the graph (shapes, axes, ...)
+MIN_SHARED_ELEMENTS = 1024
+
+
+def export_shared_weights(serving_fn, path: typing.Union[str, Path]):
+    """
+    Export a tf.function with a single input and output, its variables become memory-mappable .npy files.
+    The export is written to a temporary folder that is only renamed to path once complete.
+    """
+    import tensorflow as tf
+    from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+
+    path = Path(path)
+    frozen_fn = convert_variables_to_constants_v2(serving_fn.get_concrete_function())
+    graph_def = frozen_fn.graph.as_graph_def()
+    tmp_path = path.with_name(path.name + f".tmp-{os.getpid()}")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    (tmp_path / "weights").mkdir(parents=True)
+
+    weights = []
+    for node in graph_def.node:
+        if node.op != "Const":
+            continue
+        value = tf.make_ndarray(node.attr["value"].tensor)
+        if value.dtype == object or value.size < MIN_SHARED_ELEMENTS:
+            continue
+        file_name = f"{len(weights):04d}.npy"
+        np.save(tmp_path / "weights" / file_name, np.ascontiguousarray(value))
+        weights.append({"tensor": f"{node.name}:0", "file": file_name})
+        # the constant becomes an input fed with the memory-mapped weight
+        dtype = node.attr["dtype"]
+        node.op = "Placeholder"
+        node.ClearField("attr")
+        node.attr["dtype"].CopyFrom(dtype)
+        node.attr["shape"].shape.CopyFrom(tf.TensorShape(value.shape).as_proto())
+
+    (tmp_path / "graph.pb").write_bytes(graph_def.SerializeToString())
+    manifest = {
+        "input": frozen_fn.inputs[0].name,
+        "output": frozen_fn.outputs[0].name,
+        "weights": weights,
+    }
+    (tmp_path / "manifest.json").write_text(json.dumps(manifest, indent=2))
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another worker exported the same model first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class SharedWeightsFunction:
+    """
+    Serving function restored from export_shared_weights, called with a batch of inputs
+    """
+    def __init__(self, path: typing.Union[str, Path]):
+        import tensorflow as tf
+        path = Path(path)
+        manifest = json.loads((path / "manifest.json").read_text())
+        graph_def = tf.compat.v1.GraphDef()
+        graph_def.ParseFromString((path / "graph.pb").read_bytes())
+
+        # copy-on-write maps, DLPack only exports writable arrays. Nothing writes to them,
+        # so the pages stay the ones of the file cache, shared by every process
+        self.arrays = [np.load(path / "weights" / weight["file"], mmap_mode="c") for weight in manifest["weights"]]
+        self.weights = [tf.experimental.dlpack.from_dlpack(array.__dlpack__()) for array in self.arrays]
+        self.nbytes = sum(array.nbytes for array in self.arrays)
+
+        wrapped = tf.compat.v1.wrap_function(lambda: tf.compat.v1.import_graph_def(graph_def, name=""), [])
+        feeds = [wrapped.graph.get_tensor_by_name(manifest["input"])] + \
+                [wrapped.graph.get_tensor_by_name(weight["tensor"]) for weight in manifest["weights"]]
+        self.function = wrapped.prune(
+            feeds=feeds,
+            fetches=wrapped.graph.get_tensor_by_name(manifest["output"]),
+            input_signature=(tuple(tf.TensorSpec(feed.shape, feed.dtype) for feed in feeds), {})
+        )
+
+    def __call__(self, inputs):
+        return self.function(inputs, *self.weights)
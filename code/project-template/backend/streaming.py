@@ -0,0 +1,155 @@
+import typing
+
+from fastapi.responses import StreamingResponse
+
+# file types of a tar header that hold the content of a regular file
+TAR_REGULAR_FILE = (b"0", b"\0", b"7")
+TAR_GNU_LONG_NAME = b"L"
+TAR_BLOCK_SIZE = 512
+
+
+class FileTooLarge(Exception):
+    """
+    A file of a streamed upload larger than the allowed size, yielded in place of its
+    content: the file is skipped and the files after it are still read
+    """
+    def __init__(self, filename: str, max_size: int):
+        super().__init__(f"File '{filename}' is larger than {max_size} bytes")
+        self.filename = filename
+
+
+async def iter_multipart_files(stream: typing.AsyncIterator[bytes],
+                               boundary: bytes,
+                               max_file_size: int
+                               ) -> typing.AsyncIterator[typing.Tuple[str, typing.Union[bytes, FileTooLarge]]]:
+    """
+    Yield the (filename, content) of each file of a multipart/form-data body as soon
+    as the file is fully received, only the file being uploaded is kept in memory.
+    The content of a file larger than max_file_size is a FileTooLarge.
+    """
+    from multipart.multipart import MultipartParser, parse_options_header
+
+    completed: typing.List[typing.Tuple[str, typing.Union[bytes, FileTooLarge]]] = []
+    part = {"headers": {}, "field": b"", "value": b"", "data": bytearray(), "filename": "", "too_large": False}
+
+    def on_part_begin():
+        part["headers"], part["data"], part["too_large"] = {}, bytearray(), False
+
+    def on_header_field(data, start, end):
+        part["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][part["field"].lower()] = part["value"]
+        part["field"], part["value"] = b"", b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        part["filename"] = options.get(b"filename", b"").decode(errors="replace")
+
+    def on_part_data(data, start, end):
+        if part["too_large"]:
+            return
+        part["data"] += data[start:end]
+        if len(part["data"]) > max_file_size:
+            # the rest of the file is dropped as it arrives
+            part["too_large"], part["data"] = True, bytearray()
+
+    def on_part_end():
+        # form fields without a filename are not images
+        if part["filename"]:
+            content = FileTooLarge(part["filename"], max_file_size) if part["too_large"] else bytes(part["data"])
+            completed.append((part["filename"], content))
+        part["data"] = bytearray()
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    async for chunk in stream:
+        parser.write(chunk)
+        while completed:
+            yield completed.pop(0)
+    parser.finalize()
+    while completed:
+        yield completed.pop(0)
+
+
+async def iter_tar_files(stream: typing.AsyncIterator[bytes],
+                         max_file_size: int
+                         ) -> typing.AsyncIterator[typing.Tuple[str, typing.Union[bytes, FileTooLarge]]]:
+    """
+    Yield the (filename, content) of each regular file of an uncompressed tar stream
+    as soon as the file is fully received. The content of a file larger than
+    max_file_size is a FileTooLarge.
+    """
+    buffer = bytearray()
+    entry: typing.Optional[dict] = None
+    long_name: typing.Optional[str] = None
+
+    async for chunk in stream:
+        buffer += chunk
+        while True:
+            if entry is None:
+                if len(buffer) < TAR_BLOCK_SIZE:
+                    break
+                header = bytes(buffer[:TAR_BLOCK_SIZE])
+                del buffer[:TAR_BLOCK_SIZE]
+                if header == b"\0" * TAR_BLOCK_SIZE:
+                    continue  # end of archive marker
+                name = header[0:100].split(b"\0", 1)[0].decode(errors="replace")
+                prefix = header[345:500].split(b"\0", 1)[0].decode(errors="replace")
+                size = int(header[124:136].strip(b"\0 ") or b"0", 8)
+                entry = {
+                    "name": long_name or (f"{prefix}/{name}" if prefix else name),
+                    "type": header[156:157],
+                    "size": size,
+                    "padded_size": (size + TAR_BLOCK_SIZE - 1) // TAR_BLOCK_SIZE * TAR_BLOCK_SIZE,
+                    "too_large": size > max_file_size,
+                }
+                long_name = None
+            if entry["too_large"]:
+                # dropped as it arrives instead of buffered
+                skipped = min(len(buffer), entry["padded_size"])
+                del buffer[:skipped]
+                entry["padded_size"] -= skipped
+                if entry["padded_size"] > 0:
+                    break
+                if entry["type"] in TAR_REGULAR_FILE:
+                    yield entry["name"], FileTooLarge(entry["name"], max_file_size)
+                entry = None
+                continue
+            if len(buffer) < entry["padded_size"]:
+                break
+            content = bytes(buffer[:entry["size"]])
+            del buffer[:entry["padded_size"]]
+            if entry["type"] == TAR_GNU_LONG_NAME:
+                long_name = content.split(b"\0", 1)[0].decode(errors="replace")
+            elif entry["type"] in TAR_REGULAR_FILE:
+                yield entry["name"], content
+            entry = None
+
+
+class DuplexStreamingResponse(StreamingResponse):
+    """
+    Streaming response that can be sent while the request body is still being read.
+    StreamingResponse listens for the client disconnect by calling receive() in
+    parallel, which would steal the chunks of the body from the request stream;
+    here the disconnect is noticed by the body reader instead.
+    """
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        async for chunk in self.body_iterator:
+            if not isinstance(chunk, (bytes, memoryview)):
+                chunk = chunk.encode(self.charset)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+        if self.background is not None:
+            await self.background()
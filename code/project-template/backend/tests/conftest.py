@@ -0,0 +1,32 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# the backend modules are imported by their flat names, as the API does when run from the backend folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    """
+    File-based tracking store with two versions of an iris classifier behind the alias "production"
+    """
+    mlflow = pytest.importorskip("mlflow")
+    pytest.importorskip("sklearn")
+    from sklearn.datasets import load_iris
+    from sklearn.linear_model import LogisticRegression
+
+    tracking_uri = (tmp_path / "mlruns").as_uri()
+    monkeypatch.setenv("MLFLOW_TRACKING_URI", tracking_uri)
+    mlflow.set_tracking_uri(tracking_uri)
+    client = mlflow.tracking.MlflowClient()
+    X, y = load_iris(return_X_y=True)
+    client.create_registered_model("iris-classification-model")
+    for C in (1.0, 0.01):
+        with mlflow.start_run() as run:
+            mlflow.sklearn.log_model(LogisticRegression(C=C, max_iter=500).fit(X, y), "model")
+        client.create_model_version("iris-classification-model", f"{run.info.artifact_uri}/model", run.info.run_id)
+    client.set_registered_model_alias("iris-classification-model", "production", "1")
+    yield client
+    mlflow.set_tracking_uri(None)
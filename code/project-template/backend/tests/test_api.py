@@ -0,0 +1,71 @@
+"""
+Endpoints of the API that don't need the model files
+"""
+import pytest
+
+pytest.importorskip("fastapi")
+from api import etag_matches  # noqa: E402
+
+ETAG = '"cb54c4eafce5c78542dc04e0130859b3"'
+
+
+@pytest.mark.parametrize("if_none_match, matches", [
+    (ETAG, True),
+    (f"W/{ETAG}", True),
+    (f'"other", {ETAG}', True),
+    ("*", True),
+    ('"other"', False),
+    (ETAG[:-3] + '"', False),
+    (ETAG.strip('"'), False),
+    ("", False),
+])
+def test_if_none_match(if_none_match, matches):
+    assert etag_matches(ETAG, if_none_match) == matches
+
+
+def test_request_metrics_let_a_duplex_stream_read_its_body():
+    import asyncio
+    from fastapi import FastAPI, Request
+    from api import RequestMetricsMiddleware
+    from streaming import DuplexStreamingResponse
+
+    app = FastAPI()
+    app.add_middleware(RequestMetricsMiddleware)
+
+    @app.post("/echo")
+    async def echo(request: Request):
+        async def lines():
+            yield "started\n"
+            async for chunk in request.stream():
+                if chunk:
+                    yield chunk.decode()
+        return DuplexStreamingResponse(lines(), media_type="text/plain")
+
+    async def scenario():
+        # the client only sends the body once the response has started, like a long upload
+        response_started = asyncio.Event()
+        sent = []
+
+        async def receive():
+            await response_started.wait()
+            if sent:
+                await asyncio.Event().wait()  # no disconnect
+            sent.append(True)
+            return {"type": "http.request", "body": b"hello", "more_body": False}
+
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+            if message["type"] == "http.response.start":
+                response_started.set()
+
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+                 "scheme": "http", "path": "/echo", "raw_path": b"/echo", "root_path": "", "query_string": b"",
+                 "headers": [], "client": ("test", 1), "server": ("test", 80)}
+        await asyncio.wait_for(app(scope, receive, send), 5)
+        return messages
+
+    messages = asyncio.run(scenario())
+    assert messages[0]["status"] == 200
+    assert b"".join(message.get("body", b"") for message in messages[1:]) == b"started\nhello"
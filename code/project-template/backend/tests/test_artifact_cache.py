@@ -0,0 +1,93 @@
+"""
+Downloads and evictions of the artifact cache against a local file-based tracking store
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import artifact_cache
+from artifact_cache import ArtifactCache
+
+MODEL_NAME = "iris-classification-model"
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_versions_with_the_same_artifacts_downloaded_at_once_share_one_blob(registry, tmp_path, monkeypatch):
+    # version 3 is registered from the same run as version 1
+    v1 = registry.get_model_version(MODEL_NAME, "1")
+    v3 = registry.create_model_version(MODEL_NAME, v1.source, v1.run_id)
+
+    # both downloads are done before either moves its artifacts to the blob
+    both_downloaded = threading.Barrier(2, timeout=30)
+    directory_digest = artifact_cache.directory_digest
+
+    def digest_after_both_downloads(path):
+        both_downloaded.wait()
+        return directory_digest(path)
+
+    # and the first one to move them takes its time, the other one checks for the blob meanwhile
+    replace = os.replace
+
+    def slow_replace(src, dst):
+        if Path(dst).parent.name == "blobs":
+            time.sleep(0.5)
+        replace(src, dst)
+
+    monkeypatch.setattr(artifact_cache, "directory_digest", digest_after_both_downloads)
+    monkeypatch.setattr(os, "replace", slow_replace)
+    results = dict()
+
+    def fetch(model_version):
+        # one cache per thread, they only share the file locks like two processes would
+        results[model_version.version] = ArtifactCache(tmp_path / "artifacts").model_dir(model_version)
+
+    threads = [threading.Thread(target=fetch, args=(model_version,)) for model_version in (v1, v3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results[v1.version] == results[v3.version]
+    assert (results[v1.version] / "MLmodel").exists()
+
+
+def test_leased_blobs_are_not_evicted(registry, tmp_path):
+    cache = ArtifactCache(tmp_path / "artifacts", max_bytes=1, grace_seconds=0)
+    v1 = cache.model_dir(registry.get_model_version(MODEL_NAME, "1"), lease_pid=os.getpid())
+    v2 = cache.model_dir(registry.get_model_version(MODEL_NAME, "2"), lease_pid=os.getpid())
+    assert v1.exists() and v2.exists()
+
+    cache.release(v1)
+    cache.evict()
+    assert not v1.exists() and v2.exists()
+
+    # the lease of a process that exited doesn't hold the blob
+    cache.release(v2)
+    cache.model_dir(registry.get_model_version(MODEL_NAME, "2"), lease_pid=dead_pid())
+    cache.evict()
+    assert not v2.exists()
+
+
+def test_blobs_just_returned_are_not_evicted(registry, tmp_path):
+    cache = ArtifactCache(tmp_path / "artifacts", max_bytes=1)
+    v1 = cache.model_dir(registry.get_model_version(MODEL_NAME, "1"))
+    v2 = cache.model_dir(registry.get_model_version(MODEL_NAME, "2"))
+    assert v1.exists() and v2.exists()
+    assert cache.evictions == 0
+
+
+def test_cache_size_of_zero_means_no_limit(monkeypatch):
+    import importlib
+    monkeypatch.setenv("ARTIFACT_CACHE_SIZE_MB", "0")
+    try:
+        assert importlib.reload(artifact_cache).DEFAULT_MAX_BYTES is None
+    finally:
+        monkeypatch.delenv("ARTIFACT_CACHE_SIZE_MB")
+        importlib.reload(artifact_cache)
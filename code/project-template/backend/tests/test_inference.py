@@ -0,0 +1,97 @@
+"""
+Predictions of inference.predict while a new version of the model is swapped in
+"""
+import asyncio
+import threading
+from functools import partial
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import inference
+from batching import MicroBatcher
+from cache import PredictionCache
+from executor import InferenceExecutor
+from model_garden import ModelGarden
+
+
+class FakeModel:
+    def __init__(self, version: int, release: threading.Event):
+        self.version = version
+        self.release = release
+
+    def memory_usage(self) -> int:
+        return 1
+
+    def predict_scores(self, batch):
+        # version 1 answers only once the test lets it, after the swap
+        if self.version == 1:
+            self.release.wait(5)
+        return np.full((len(batch), 2), float(self.version))
+
+    def format_outputs(self, scores, top_k=None, columnar=False):
+        return {"version": self.version, "score": float(scores[0, 0])}
+
+
+@pytest.mark.parametrize("batching", [False, True])
+def test_prediction_in_flight_during_a_swap_uses_a_single_version(batching):
+    async def scenario():
+        release = threading.Event()
+        garden = ModelGarden()
+        garden.register("model", partial(FakeModel, 1, release), version=1)
+        executor = InferenceExecutor("model", max_workers=2)
+        batchers = dict()
+        if batching:
+            batchers["model"] = MicroBatcher("model", executor=executor, max_wait_ms=1.0)
+            await batchers["model"].start()
+        app_state = SimpleNamespace(model_garden=garden, executors={"model": executor},
+                                    batchers=batchers, prediction_cache=PredictionCache())
+
+        in_flight = asyncio.create_task(inference.predict(app_state, "model", [1.0]))
+        await asyncio.sleep(0.05)
+        await garden.swap("model", 2, partial(FakeModel, 2, release))
+        after_swap = await inference.predict(app_state, "model", [2.0])
+        release.set()
+
+        # predicted and formatted by version 1 although version 2 is served by now,
+        # its late result isn't cached over the ones of version 2
+        assert await in_flight == {"version": 1, "score": 1.0}
+        assert after_swap == {"version": 2, "score": 2.0}
+        assert app_state.prediction_cache.entries.keys() == {("model", 2, inference.content_key([2.0]))}
+        assert app_state.prediction_cache.get("model", 1, inference.content_key([1.0])) is None
+        for batcher in batchers.values():
+            await batcher.stop()
+        executor.shutdown()
+
+    asyncio.run(scenario())
+
+
+class PickyModel:
+    version = 1
+
+    def memory_usage(self) -> int:
+        return 1
+
+    def predict_scores(self, batch):
+        if any(x < 0 for x in batch):
+            raise ValueError("Invalid input")
+        return np.array([[x] for x in batch], dtype=np.float64)
+
+
+def test_a_broken_input_only_fails_its_own_request_in_a_batch():
+    async def scenario():
+        model = PickyModel()
+        executor = InferenceExecutor("model", max_workers=1)
+        batcher = MicroBatcher("model", executor=executor, max_wait_ms=50.0)
+        await batcher.start()
+        good, bad = await asyncio.gather(batcher.submit(1.0, model), batcher.submit(-1.0, model),
+                                         return_exceptions=True)
+        # both were in the same batch, which failed as a whole before being retried input by input
+        assert batcher.stats.total_batches == 1
+        np.testing.assert_allclose(good, [1.0])
+        assert isinstance(bad, ValueError)
+        await batcher.stop()
+        executor.shutdown()
+
+    asyncio.run(scenario())
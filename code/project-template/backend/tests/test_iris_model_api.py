@@ -0,0 +1,69 @@
+"""
+Bulk predictions of the iris model while a new version of the model is swapped in
+"""
+import asyncio
+import json
+import threading
+from functools import partial
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("fastapi")
+import iris_model_api  # noqa: E402
+from executor import InferenceExecutor  # noqa: E402
+from model_garden import ModelGarden  # noqa: E402
+from models import Model  # noqa: E402
+
+
+class FakeModel:
+    classes = ["setosa", "versicolor"]
+    format_outputs = Model.format_outputs
+
+    def __init__(self, version: int, swapped: threading.Event):
+        self.version = version
+        self.swapped = swapped
+
+    def memory_usage(self) -> int:
+        return 1
+
+    def predict_scores(self, X):
+        # version 1 scores its first chunk only once version 2 is served
+        if self.version == 1:
+            self.swapped.wait(5)
+        return np.full((len(X), 2), self.version / 3)
+
+
+class FakeRequest:
+    def __init__(self, app_state, body: dict):
+        self.app = SimpleNamespace(state=app_state)
+        self.headers = {"content-type": "application/json"}
+        self.body_bytes = json.dumps(body).encode()
+
+    async def body(self) -> bytes:
+        return self.body_bytes
+
+
+def test_bulk_prediction_during_a_swap_uses_a_single_version(monkeypatch):
+    monkeypatch.setattr(iris_model_api, "BULK_CHUNK_SIZE", 1)
+
+    async def scenario():
+        swapped = threading.Event()
+        garden = ModelGarden()
+        garden.register("iris-model", partial(FakeModel, 1, swapped), version=1)
+        executor = InferenceExecutor("iris-model", max_workers=1)
+        app_state = SimpleNamespace(model_garden=garden, executors={"iris-model": executor})
+        body = {name: [1.0, 2.0, 3.0] for name in iris_model_api.FEATURES}
+
+        in_flight = asyncio.create_task(iris_model_api.predict_bulk(FakeRequest(app_state, body)))
+        await asyncio.sleep(0.05)
+        await garden.swap("iris-model", 2, partial(FakeModel, 2, swapped))
+        swapped.set()
+
+        # every chunk scored by version 1, rounded by the model
+        response = await in_flight
+        assert json.loads(response.body) == {"setosa": [0.333] * 3, "versicolor": [0.333] * 3}
+        executor.shutdown()
+
+    asyncio.run(scenario())
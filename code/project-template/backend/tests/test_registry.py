@@ -0,0 +1,126 @@
+"""
+Hot swap of the models of the garden when an alias of the MLflow model registry
+moves, against a local file-based tracking store. Run from the backend folder:
+
+    python -m pytest tests
+"""
+import asyncio
+import gc
+import weakref
+from functools import partial
+
+import numpy as np
+import pytest
+
+from model_garden import ModelGarden
+
+IRIS_SAMPLE = np.array([[5.9, 3.0, 4.2, 1.5]], dtype=np.float32)
+
+
+class FakeModel:
+    def __init__(self, version: int):
+        self.version = version
+
+    def memory_usage(self) -> int:
+        return 1
+
+
+def wait_for_retired(garden: ModelGarden):
+    return asyncio.gather(*garden.retiring)
+
+
+def test_swap_lets_in_flight_requests_finish_on_the_previous_version():
+    async def scenario():
+        garden = ModelGarden()
+        garden.register("model", partial(FakeModel, 1), version=1)
+        async with garden.use("model") as in_flight:
+            await garden.swap("model", 2, partial(FakeModel, 2))
+            # new requests get the new version, the request in flight keeps the previous one
+            assert (await garden.get("model")).version == 2
+            assert in_flight.version == 1
+            assert garden.entry("model", 1).model is in_flight
+            await asyncio.sleep(0.1)
+            assert ("model", 1) in garden.entries
+        released = weakref.ref(in_flight)
+        del in_flight
+        await wait_for_retired(garden)
+        gc.collect()
+        assert ("model", 1) not in garden.entries
+        assert released() is None
+
+    asyncio.run(scenario())
+
+
+def test_swap_never_evicts_the_version_being_served():
+    async def scenario():
+        garden = ModelGarden(max_models=1)
+        garden.register("model", partial(FakeModel, 1), version=1)
+        serving = await garden.get("model")
+        await garden.swap("model", 2, partial(FakeModel, 2))
+        # loading the new version went over max_models, the previous one was kept until the swap finished
+        assert garden.entry("model", 1).model is serving
+        assert not garden.entry("model", 1).pinned
+        await wait_for_retired(garden)
+        assert list(garden.resident) == [("model", 2)]
+
+    asyncio.run(scenario())
+
+
+def test_failed_swap_keeps_serving_the_previous_version():
+    def broken():
+        raise OSError("no weights")
+
+    async def scenario():
+        garden = ModelGarden()
+        garden.register("model", partial(FakeModel, 1), version=1)
+        with pytest.raises(OSError):
+            await garden.swap("model", 2, broken)
+        assert (await garden.get("model")).version == 1
+        assert ("model", 2) not in garden.entries
+
+    asyncio.run(scenario())
+
+
+def test_watcher_follows_the_alias(registry, tmp_path):
+    from artifact_cache import ArtifactCache
+    from models import Framework, IrisModel
+    from registry import RegistryModel, RegistryWatcher
+
+    async def scenario():
+        builder = partial(IrisModel, framework=Framework.sklearn)
+        garden = ModelGarden()
+        garden.register("iris-model", partial(builder, model_path="/nonexistent", version=0), version=0)
+        watcher = RegistryWatcher(
+            garden,
+            [RegistryModel("iris-model", "iris-classification-model", "production", builder)],
+            artifact_cache=ArtifactCache(tmp_path / "artifacts")
+        )
+
+        await watcher.poll()
+        v1 = await garden.get("iris-model")
+        assert v1.version == 1
+        v1_scores = v1.predict_scores(IRIS_SAMPLE)
+
+        async with garden.use("iris-model") as in_flight:
+            registry.set_registered_model_alias("iris-classification-model", "production", "2")
+            await watcher.poll()
+            v2 = await garden.get("iris-model")
+            assert v2.version == 2
+            assert not np.allclose(v2.predict_scores(IRIS_SAMPLE), v1_scores)
+            # the request that started on version 1 finishes on it
+            assert in_flight is v1
+            np.testing.assert_allclose(in_flight.predict_scores(IRIS_SAMPLE), v1_scores)
+
+        released = weakref.ref(v1)
+        del v1, in_flight
+        await wait_for_retired(garden)
+        gc.collect()
+        assert ("iris-model", 1) not in garden.entries
+        assert released() is None
+        assert watcher.status()["models"]["iris-model"]["served_version"] == 2
+
+        # polling again with the alias unchanged doesn't swap
+        await watcher.poll()
+        assert watcher.models[0].swaps == 2
+
+    asyncio.run(scenario())
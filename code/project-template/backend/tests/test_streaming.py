@@ -0,0 +1,98 @@
+"""
+Streaming endpoint of the flowers model: uploads parsed as they arrive and scored in batches
+"""
+import asyncio
+import io
+import json
+import tarfile
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("multipart")
+import flowers_model_api  # noqa: E402
+from executor import InferenceExecutor  # noqa: E402
+from model_garden import ModelGarden  # noqa: E402
+from streaming import iter_multipart_files, iter_tar_files  # noqa: E402
+
+MAX_SIZE = 100
+FILES = [("a.jpg", b"a" * 10), ("big.jpg", b"b" * (MAX_SIZE + 1)), ("c.jpg", b"c" * 10)]
+
+
+class FakeModel:
+    def memory_usage(self) -> int:
+        return 1
+
+    def predict_scores(self, images):
+        return np.array([[len(image)] for image in images], dtype=np.float32)
+
+    def format_outputs(self, probs, top_k=None, columnar=False):
+        return [{"size": int(row[0])} for row in probs]
+
+
+def multipart_body(boundary: bytes) -> bytes:
+    body = b""
+    for filename, content in FILES:
+        body += (b"--" + boundary + b"\r\n"
+                 b'Content-Disposition: form-data; name="images"; filename="' + filename.encode() + b'"\r\n'
+                 b"Content-Type: image/jpeg\r\n\r\n" + content + b"\r\n")
+    return body + b"--" + boundary + b"--\r\n"
+
+
+def tar_body() -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for filename, content in FILES:
+            info = tarfile.TarInfo(filename)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+async def chunks(body: bytes, size: int = 7):
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+
+@pytest.mark.parametrize("upload", ["multipart", "tar"])
+def test_a_file_too_large_only_fails_itself(upload):
+    async def scenario():
+        garden = ModelGarden()
+        garden.register("flowers-model", FakeModel)
+        app_state = SimpleNamespace(model_garden=garden,
+                                    executors={"flowers-model": InferenceExecutor("flowers-model")})
+        if upload == "multipart":
+            files = iter_multipart_files(chunks(multipart_body(b"boundary")), b"boundary", MAX_SIZE)
+        else:
+            files = iter_tar_files(chunks(tar_body()), MAX_SIZE)
+        return [json.loads(line) async for line in flowers_model_api.stream_predictions(app_state, files, None)]
+
+    records = asyncio.run(scenario())
+    assert records == [
+        {"index": 0, "filename": "a.jpg", "predictions": {"size": 10}},
+        {"index": 1, "filename": "big.jpg", "error": f"File 'big.jpg' is larger than {MAX_SIZE} bytes"},
+        {"index": 2, "filename": "c.jpg", "predictions": {"size": 10}},
+    ]
+
+
+def test_images_get_an_error_record_while_the_executor_stays_saturated(monkeypatch):
+    monkeypatch.setattr(flowers_model_api, "STREAM_SATURATED_BACKOFF", 0.001)
+
+    async def scenario():
+        garden = ModelGarden()
+        garden.register("flowers-model", FakeModel)
+        executor = InferenceExecutor("flowers-model", max_workers=1, max_queue=0)
+        executor.in_flight = 1  # every worker busy for the whole upload
+        app_state = SimpleNamespace(model_garden=garden, executors={"flowers-model": executor})
+        files = iter_tar_files(chunks(tar_body()), MAX_SIZE)
+        return [json.loads(line) async for line in flowers_model_api.stream_predictions(app_state, files, None)]
+
+    records = asyncio.run(asyncio.wait_for(scenario(), 5))
+    saturated = "Inference executor for 'flowers-model' is saturated"
+    assert records == [
+        {"index": 0, "filename": "a.jpg", "error": saturated},
+        {"index": 1, "filename": "big.jpg", "error": f"File 'big.jpg' is larger than {MAX_SIZE} bytes"},
+        {"index": 2, "filename": "c.jpg", "error": saturated},
+    ]
@@ -1,33 +1,143 @@
 import streamlit as st
 import requests
-import json
+import hashlib
 import os
+import uuid
+from io import BytesIO
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from streamlit_js_eval import get_geolocation
 
 API_URL = os.getenv('API_URL', 'http://localhost:8080')
+# (connect, read) timeouts of the calls to the API in seconds
+API_TIMEOUT = (float(os.getenv('API_CONNECT_TIMEOUT', 3.05)), float(os.getenv('API_READ_TIMEOUT', 30)))
+# retries of the calls that fail to connect or get a 502/503/504 from the API
+API_RETRIES = int(os.getenv('API_RETRIES', 3))
+# connections kept alive with the API, shared by all the sessions of the Streamlit server
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', 10))
+# predictions memoized by the frontend, keyed by model version, image hash and coordinates
+PREDICTION_CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', 256))
+PREDICTION_CACHE_TTL = int(os.getenv('PREDICTION_CACHE_TTL', 600))
 print("API_URL", API_URL)
 
 
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """
+    Keep-alive session to the API, created once per Streamlit server process and
+    reused by every rerun of the script, so each call doesn't open a new connection
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=API_RETRIES,
+        backoff_factor=0.3,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=None,  # the predictions are idempotent, POST can be retried too
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class MultipartBody:
+    """
+    multipart/form-data body sent from the buffers of its parts without copying them.
+    requests would read the whole file into a new bytes object to encode it, while this
+    body has a length (so it is sent with a Content-Length) and yields the file buffer as is.
+    """
+
+    def __init__(self, fields: dict, files: dict):
+        self.boundary = uuid.uuid4().hex
+        self.parts = []
+        for name, value in fields.items():
+            self.parts.append((f'--{self.boundary}\r\n'
+                               f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                               f'{value}\r\n').encode())
+        for name, (filename, buffer, content_type) in files.items():
+            self.parts.append((f'--{self.boundary}\r\n'
+                               f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                               f'Content-Type: {content_type}\r\n\r\n').encode())
+            self.parts.append(buffer)
+            self.parts.append(b'\r\n')
+        self.parts.append(f'--{self.boundary}--\r\n'.encode())
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return sum(memoryview(part).nbytes for part in self.parts)
+
+    def __iter__(self):
+        return iter(self.parts)
+
+
 def call_iris_model(sepal_length, sepal_width, petal_length, petal_width):
     """
     This function calls the iris model
     """
     url = f"{API_URL}/iris-model/predict"
 
-    payload = json.dumps({
+    payload = {
     "sepal_length": sepal_length,
     "sepal_width": sepal_width,
     "petal_length": petal_length,
     "petal_width": petal_width
-    })
-    headers = {
-    'Content-Type': 'application/json'
     }
-
-    response = requests.request("POST", url, headers=headers, data=payload)
+    response = get_http_session().post(url, json=payload, timeout=API_TIMEOUT)
     return response.json()
 
-def call_flowers_model(image_file, lat=0.0, lng=0.0):
+@st.cache_resource
+def get_metadata_cache() -> dict:
+    """
+    Last metadata returned by the API for each model, with its ETag, shared by all the sessions
+    """
+    return dict()
+
+
+def get_model_metadata(model_name):
+    """
+    Metadata of a model published by the API: version, classes and expected input.
+    It is revalidated with its ETag on every call, the API answers 304 without a body
+    (and without loading the model) until the version changes, so the version used
+    to key the memoized predictions is never stale.
+    """
+    cache = get_metadata_cache()
+    headers = {'If-None-Match': cache[model_name][0]} if model_name in cache else {}
+    response = get_http_session().get(f"{API_URL}/models/{model_name}/metadata",
+                                      headers=headers, timeout=API_TIMEOUT)
+    if response.status_code == 304:
+        return cache[model_name][1]
+    response.raise_for_status()
+    metadata = response.json()
+    cache[model_name] = (response.headers.get('ETag', ''), metadata)
+    return metadata
+
+
+@st.cache_data(max_entries=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL, show_spinner=False)
+def downscale_image(image_hash, image_size, _image_file):
+    """
+    Resize the image to the input size of the model before uploading it, the model
+    would resize it anyway. Returns the JPEG bytes to upload, or None when the image
+    is already small enough and is uploaded as is. _image_file isn't hashed, image_hash is the key.
+    """
+    height, width = image_size
+    _image_file.seek(0)
+    image = Image.open(_image_file)
+    if image.width <= width and image.height <= height:
+        return None
+    # decode JPEGs at a reduced scale, then resize like the model does (bilinear, no aspect ratio)
+    image.draft("RGB", (width, height))
+    image = image.convert("RGB").resize((width, height), Image.BILINEAR)
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+
+def call_flowers_model(image_bytes, filename, content_type, lat=0.0, lng=0.0):
     """
     This function calls the flowers model
     """
@@ -36,14 +146,40 @@ def call_flowers_model(image_file, lat=0.0, lng=0.0):
         'lat': lat,
         'lng': lng
         }
-    files=[
-    ('image',image_file)
-    ]
-    headers = {}
-    response = requests.request("POST", url, headers=headers, data=payload, files=files)
+    # the image is already in memory, send its buffer instead of a copy
+    files = {
+        'image': (filename, memoryview(image_bytes), content_type or 'application/octet-stream')
+    }
+    body = MultipartBody(payload, files)
+    headers = {'Content-Type': body.content_type}
+    response = get_http_session().post(url, headers=headers, data=body, timeout=API_TIMEOUT)
+    response.raise_for_status()
     return response.json()
 
 
+def api_error_message(error: requests.HTTPError) -> str:
+    """
+    Status and detail of a failed call to the API, to show it on the page
+    """
+    response = error.response
+    try:
+        detail = response.json().get('detail', response.text)
+    except ValueError:
+        detail = response.text
+    return f"The API answered {response.status_code} {response.reason}: {detail}"
+
+
+@st.cache_data(max_entries=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL, show_spinner=False)
+def predict_flowers(model_version, image_hash, lat, lng, _image_bytes, filename, content_type):
+    """
+    Memoized call of the flowers model, a rerun with the same image and coordinates
+    doesn't reach the API. The model version is part of the key so a new version isn't
+    served stale results. _image_bytes isn't hashed, image_hash is the key.
+    A failed call raises requests.HTTPError, so its error isn't memoized.
+    """
+    return call_flowers_model(_image_bytes, filename, content_type, lat, lng)
+
+
 
 def iris_model_form():
     """
@@ -77,7 +213,21 @@ def flowers_model_form():
         st.image(image_file, caption='Uploaded Image.', use_column_width=True)
         is_clicked = st.button('Classify')
         if is_clicked:
-            json_result = call_flowers_model(image_file, lat, lng)
+            try:
+                metadata = get_model_metadata("flowers-model")
+                # a view of the uploaded file, not a copy
+                image_bytes = image_file.getbuffer()
+                image_hash = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+                content_type = image_file.type
+                resized = downscale_image(image_hash, tuple(metadata["input"]["image_size"]), image_file)
+                if resized is not None:
+                    image_bytes, content_type = resized, "image/jpeg"
+                json_result = predict_flowers(metadata["version"], image_hash, lat, lng,
+                                              image_bytes, image_file.name, content_type)
+            except requests.HTTPError as e:
+                # e.g. a 503 while the API is busy or still loading the model
+                st.error(api_error_message(e))
+                return
             st.write(json_result)
             st.snow()
 